@@ -0,0 +1,142 @@
+# Edge-to-hub aggregation: many websocket.py instances (edges) forward their events to one websocket.py instance (the
+# hub), a dashboard needs one websocket connection to the hub instead of one per site pc.
+#
+# edge: EdgeUplink keeps one websocket connection to <hub>/edge?node=<name> and forwards every event of the local
+# broadcast hub, all readers over the same connection.  The events that are available are sent together, as one json
+# array per message.
+# hub: EdgeHub receives the events of the edges and publishes them on its own broadcast hub, i.e. the events of all
+# edges form one stream with one sequence number (seq).  Every event is tagged with the node and the seq of the edge
+# (node_seq).  The hub publishes {"edge_state": {"node": <name>, "state": true/false}} when an edge connects or
+# disconnects.
+#
+# Reconnect: the hub answers a new connection with {"last_seq": <seq>}, the last event it received from that node (or
+# null, e.g. after a restart of the hub).  Every message of the edge is acknowledged the same way.  The edge continues
+# after last_seq (or after the last acknowledged event), the missed events come from the replay buffer of its broadcast
+# hub.  Events the hub already received are skipped, e.g. when the edge sends an event again after a reconnect.
+
+import asyncio, json, time
+import websockets
+
+RECONNECT_DELAYS = (0.5, 1, 2, 5, 10, 30) # seconds, the last one is repeated
+
+
+# runs on the event loop of the edge, hub is the local BroadcastHub
+class EdgeUplink():
+    def __init__(self, hub, url, node, batch_max=500):
+        self.hub = hub
+        self.url = url # e.g. ws://hub:8765/edge
+        self.node = node
+        self.batch_max = batch_max # events per message
+        self.sent_seq = None # seq of the last event that is sent
+        self.acked_seq = None # seq of the last event that the hub received
+        self.connected = False
+        self.error = None
+        self.connect_ctr = 0
+        self.event_ctr = 0
+        self.message_ctr = 0
+        self.incomplete_ctr = 0 # reconnects where events were lost (not in the replay buffer anymore)
+
+    async def run(self):
+        attempt = 0
+        while True:
+            try:
+                async with websockets.connect(f"{self.url}?node={self.node}", max_queue=None) as ws:
+                    last_seq = json.loads(await ws.recv()).get("last_seq")
+                    self.connected, self.error = True, None
+                    self.connect_ctr += 1
+                    attempt = 0
+                    await self.forward(ws, self.acked_seq if last_seq is None else last_seq)
+            except asyncio.CancelledError:
+                raise
+            except Exception as e:
+                self.error = str(e)
+            finally:
+                self.connected = False
+            await asyncio.sleep(RECONNECT_DELAYS[min(attempt, len(RECONNECT_DELAYS) - 1)])
+            attempt += 1
+
+    # an uplink is not dropped or coalesced as a slow client: when it falls behind too far, it is disconnected and
+    # continues from the replay buffer
+    async def forward(self, ws, last_seq):
+        subscriber = self.hub.subscribe(last_seq, maxlen=self.hub.history.maxlen, policy="disconnect")
+        acks = asyncio.create_task(self.receive_acks(ws, subscriber))
+        try:
+            batch = []
+            if subscriber.replay is not None:
+                self.incomplete_ctr += not subscriber.replay["complete"]
+                batch = subscriber.replay["replay"]
+            while True:
+                if not batch:
+                    item = await subscriber.get()
+                    if item is None:
+                        return
+                    batch.append(item[0])
+                while len(batch) < self.batch_max:
+                    item = subscriber.get_nowait()
+                    if item is None:
+                        break
+                    batch.append(item[0])
+                await ws.send(json.dumps(batch, separators=(",", ":")))
+                self.sent_seq = batch[-1]["seq"]
+                self.event_ctr += len(batch)
+                self.message_ctr += 1
+                batch = []
+        finally:
+            acks.cancel()
+            self.hub.unsubscribe(subscriber)
+
+    # the subscriber is closed when the connection is closed, i.e. forward() does not wait for the next event
+    async def receive_acks(self, ws, subscriber):
+        try:
+            async for message in ws:
+                self.acked_seq = json.loads(message)["last_seq"]
+        finally:
+            subscriber.closed = True
+            subscriber.wakeup.set()
+
+    def stats(self):
+        return {"url": self.url, "node": self.node, "connected": self.connected, "error": self.error, "connects": self.connect_ctr,
+                "events": self.event_ctr, "messages": self.message_ctr, "sent_seq": self.sent_seq, "acked_seq": self.acked_seq,
+                "incomplete_replays": self.incomplete_ctr}
+
+
+# runs on the event loop of the hub, publish is BroadcastHub.publish
+class EdgeHub():
+    def __init__(self, publish):
+        self.publish = publish
+        self.nodes = {} # name: {"connections", "last_seq", "events", "connected"}
+        self.event_ctr = 0
+        self.duplicate_ctr = 0
+
+    async def serve(self, ws, node):
+        info = self.nodes.setdefault(node, {"connections": 0, "last_seq": None, "events": 0, "connected": None})
+        await ws.send_text(json.dumps({"last_seq": info["last_seq"]}))
+        info["connections"] += 1
+        info["connected"] = time.time()
+        self.publish(({"edge_state": {"node": node, "state": True}}, None))
+        try:
+            while True:
+                self.receive(info, node, json.loads(await ws.receive_text()))
+                await ws.send_text(json.dumps({"last_seq": info["last_seq"]}))
+        finally:
+            info["connections"] -= 1
+            if not info["connections"]:
+                self.publish(({"edge_state": {"node": node, "state": False}}, None))
+
+    def receive(self, info, node, events):
+        last_seq = info["last_seq"] or 0
+        for event in events:
+            seq = event.pop("seq", 0)
+            if seq <= last_seq:
+                self.duplicate_ctr += 1
+                continue
+            event["node"] = node
+            event["node_seq"] = last_seq = seq
+            self.publish((event, None))
+        info["events"] += len(events)
+        info["last_seq"] = last_seq
+        self.event_ctr += len(events)
+
+    def stats(self):
+        return {"nodes": len(self.nodes), "connected": sum(1 for i in self.nodes.values() if i["connections"]), "events": self.event_ctr,
+                "duplicates": self.duplicate_ctr, "edges": {node: {**info} for node, info in self.nodes.items()}}
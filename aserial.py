@@ -0,0 +1,91 @@
+# Serial ports on the event loop.  The port is non-blocking (pyserial opens it with O_NONBLOCK on posix), a command is
+# written and the response is awaited with loop.add_reader on the file descriptor.  All readers, the hotplug detection
+# and the websocket clients share one event loop: no thread per reader, no locks and no thread switches per poll.
+# Blocking calls (opening a port, listing the ports) run in the default executor.
+# On windows the event loop cannot wait for a serial port, there the (blocking) driver.poll runs in the executor.
+
+import asyncio, functools, os, time
+import serial
+from hotplug import open_delays
+
+posix = os.name == "posix"
+
+
+def open_serial(port_name):
+    return serial.Serial(port_name, baudrate=115200, bytesize=serial.EIGHTBITS, parity=serial.PARITY_NONE, stopbits=serial.STOPBITS_ONE, timeout=0.1)
+
+
+# Although the port is present as /dev/ttyUSBxx, it is not always accessible yet.  Try a few times with an increasing
+# delay in between.  Returns an AsyncPort, or None when the port could not be opened (in about 10 seconds).
+async def open_port(port_name):
+    loop = asyncio.get_running_loop()
+    for delay in open_delays():
+        try:
+            return AsyncPort(await loop.run_in_executor(None, functools.partial(open_serial, port_name)))
+        except Exception:
+            await asyncio.sleep(delay)
+    return None
+
+
+def resolve(future, value):
+    if not future.done():
+        future.set_result(value)
+
+
+class AsyncPort():
+    def __init__(self, serial_port, timeout=0.1):
+        self.serial = serial_port
+        self.timeout = timeout # seconds, as the timeout of the serial port
+        self.loop = asyncio.get_running_loop()
+        self.fd = serial_port.fileno() if posix else None
+        self.received = None # time.perf_counter() when the last data is received, i.e. the capture time of a response
+
+    # returns the badge code or None, see protocol.ReaderDriver
+    async def poll(self, driver):
+        if self.fd is None:
+            code = await self.loop.run_in_executor(None, driver.poll, self.serial)
+            self.received = time.perf_counter()
+            return code
+        return await driver.apoll(self)
+
+    # a command is a few bytes, they fit in the (empty) output buffer, i.e. this does not block
+    def write(self, data):
+        os.write(self.fd, data)
+
+    # returns at most size bytes, or b"" when nothing is received before the timeout
+    async def read(self, size):
+        data = self.read_nowait(size)
+        if data:
+            return data
+        readable = self.loop.create_future()
+        self.loop.add_reader(self.fd, resolve, readable, True)
+        timer = self.loop.call_later(self.timeout, resolve, readable, False)
+        try:
+            if not await readable:
+                return b""
+        finally:
+            self.loop.remove_reader(self.fd)
+            timer.cancel()
+        data = self.read_nowait(size)
+        if not data:
+            raise serial.SerialException("device reports readiness to read but returned no data (device disconnected?)")
+        return data
+
+    # drop the bytes that are received but not read yet, as serial.Serial.reset_input_buffer
+    def reset_input_buffer(self):
+        try:
+            while os.read(self.fd, 256):
+                pass
+        except BlockingIOError:
+            pass
+
+    def read_nowait(self, size):
+        try:
+            data = os.read(self.fd, size)
+        except BlockingIOError:
+            return b""
+        self.received = time.perf_counter()
+        return data
+
+    def close(self):
+        self.serial.close()
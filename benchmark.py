@@ -0,0 +1,604 @@
+# Load test and benchmarks for websocket.py and rfidusb.py, no RFID reader required.
+# The server runs in a separate thread, the clients run on the event loop of the main thread.  The RFID readers are
+# emulated by simulator.py (linux), the badge-registration-server by a local stub.
+#
+# python benchmark.py broadcast --clients 500 --events 200   every websocket client must receive every event
+# python benchmark.py protocol --polls 100000                decode speed of the reader protocol
+# python benchmark.py latency --scans 200 --readers 2        scan to websocket latency
+# python benchmark.py uplink --scans 200 --readers 2         scan to POST (badge-registration-server) latency, rfidusb.py
+# python benchmark.py uplink --delay 150 --known             scan to feedback latency, badges known in advance or not
+# python benchmark.py uplink --batch 50 --known              batch mode, --no-batch-api: the server does not support batches
+# python benchmark.py throughput --rates 10,20,40,80         maximum sustainable scans per second, one reader
+# python benchmark.py cpu --readers 4 --seconds 5            cpu usage per reader
+# python benchmark.py aggregate --edges 200 --processes 4    edges (in separate processes) forward their events to a hub
+# python benchmark.py wire --events 10000                    bytes on the wire and cpu of the websocket wire formats
+# python benchmark.py recovery --stall 5                     a reader that does not answer is reopened by the watchdog
+# python benchmark.py all                                    all of the above, with default settings
+
+import argparse, asyncio, datetime, http.server, json, multiprocessing, socket, statistics, sys, threading, time, types
+import uvicorn
+import websockets
+
+import websocket as ws_server
+import aggregate, protocol, simulator, wire
+
+
+def free_port():
+    with socket.socket() as s:
+        s.bind(("localhost", 0))
+        return s.getsockname()[1]
+
+
+def start_server(port, app=ws_server.app):
+    server = uvicorn.Server(uvicorn.Config(app, host="localhost", port=port, log_level="warning"))
+    thread = threading.Thread(target=server.run, daemon=True)
+    thread.start()
+    while not server.started:
+        time.sleep(0.01)
+    return server, thread
+
+
+def percentiles(samples):
+    samples = sorted(samples)
+    if not samples:
+        return {}
+    pick = lambda p: samples[min(len(samples) - 1, int(len(samples) * p))]
+    return {"min": samples[0], "p50": pick(0.5), "p90": pick(0.9), "p99": pick(0.99), "max": samples[-1], "mean": statistics.mean(samples)}
+
+
+def print_result(title, result):
+    print(title)
+    for key, value in result.items():
+        if key.endswith("latency"):
+            print(f"  {key}: " + ", ".join(f"{k} {v * 1000:.2f}ms" for k, v in value.items()))
+        else:
+            print(f"  {key}: {value}")
+
+
+# Every client has to receive every scan, in order.
+async def broadcast(port, nbr_clients, nbr_events, rate):
+    uri = f"ws://localhost:{port}/ws"
+    clients = [await websockets.connect(uri, max_queue=None) for _ in range(nbr_clients)]
+    while ws_server.hub.stats()["clients"] < nbr_clients:
+        await asyncio.sleep(0.01)
+    latencies = []
+
+    async def receive(client):
+        codes = []
+        while len(codes) < nbr_events:
+            data = json.loads(await client.recv())
+            if "read" in data:
+                latencies.append(time.perf_counter() - data["read"]["sent"])
+                codes.append(data["read"]["code"])
+        return codes
+
+    receivers = [asyncio.create_task(receive(c)) for c in clients]
+    start = time.perf_counter()
+    for i in range(nbr_events):
+        ws_server.event_queue.put({"read": {"code": f"{i:08X}", "sent": time.perf_counter()}})
+        await asyncio.sleep(1 / rate if rate else 0)
+    try:
+        results = await asyncio.wait_for(asyncio.gather(*receivers), timeout=60)
+    except asyncio.TimeoutError:
+        results = [r.result() if r.done() else [] for r in receivers]
+    duration = time.perf_counter() - start
+    hub_stats = ws_server.hub.stats()
+    for client in clients:
+        await client.close()
+    expected = [f"{i:08X}" for i in range(nbr_events)]
+    complete = sum(1 for r in results if r == expected)
+    return {"clients": nbr_clients, "events": nbr_events, "clients with every event in order": complete,
+            "events/s delivered": round(nbr_clients * nbr_events / duration), "server": hub_stats,
+            "latency": percentiles(latencies)}
+
+
+# Serial port that answers every command with the same response, without I/O
+class ResponsePort():
+    def __init__(self, response):
+        self.response = response
+        self.pending = b""
+
+    def write(self, data):
+        self.pending += self.response
+
+    def read(self, size):
+        data, self.pending = self.pending[:size], self.pending[size:]
+        return data
+
+    def reset_input_buffer(self):
+        self.pending = b""
+
+
+# the hot path: send the read command, decode the response and return the badge code
+def protocol_poll(nbr_polls):
+    cases = {"no badge": bytes.fromhex("cddc00800080"), "4 byte uid": simulator.uid_response(bytes(range(1, 5))),
+             "10 byte uid": simulator.uid_response(bytes(range(1, 11))), "garbage + 4 byte uid": b"\x00\xcd\x13" + simulator.uid_response(bytes(range(1, 5)))}
+    result = {}
+    for name, response in cases.items():
+        driver = protocol.create_driver("7941W")
+        port = ResponsePort(response)
+        start = time.perf_counter()
+        for _ in range(nbr_polls):
+            driver.poll(port)
+        result[name] = f"{(time.perf_counter() - start) / nbr_polls * 1e6:.2f}us/poll, code {driver.poll(port)}"
+    return result
+
+
+def start_readers(nbr_readers, **kwargs):
+    return [simulator.SimulatedReader(f"sim-{i + 1}", **kwargs) for i in range(nbr_readers)]
+
+
+def stop_readers(readers):
+    for reader in readers:
+        reader.detach()
+
+
+async def wait_for_ws_readers(readers, timeout=10):
+    end = time.monotonic() + timeout
+    while time.monotonic() < end:
+        connected = {(r["reader"], r["port"]) for r in ws_server.reader_manager.stats() if r["state"]}
+        if all((r.reader_id, r.port_name) in connected for r in readers):
+            return
+        await asyncio.sleep(0.05)
+    raise TimeoutError("simulated readers are not connected")
+
+
+# Tap a new badge every 1/rate seconds, round robin over the readers.  The latency is measured from the moment the
+# simulated reader returns the badge (taps) and from the moment the badge is presented (presented), i.e. the latter
+# includes the wait for the next poll.
+async def latency(port, nbr_readers, nbr_scans, rate):
+    readers = start_readers(nbr_readers)
+    await wait_for_ws_readers(readers)
+    client = await websockets.connect(f"ws://localhost:{port}/ws", max_queue=None)
+    presented = {}
+    received = {}
+
+    async def receive():
+        while len(received) < nbr_scans:
+            data = json.loads(await client.recv())
+            if "read" in data:
+                received.setdefault(data["read"]["code"], time.perf_counter())
+
+    receiver = asyncio.create_task(receive())
+    for i in range(nbr_scans):
+        code = f"{i:08x}"
+        presented[code] = time.perf_counter()
+        readers[i % nbr_readers].tap(code, duration=0.2)
+        await asyncio.sleep(1 / rate)
+    try:
+        await asyncio.wait_for(receiver, timeout=10)
+    except asyncio.TimeoutError:
+        pass
+    await client.close()
+    stop_readers(readers)
+    taps = {c: t for r in readers for c, t in r.taps.items()}
+    return {"readers": nbr_readers, "scans": nbr_scans, "received": len(received),
+            "scan-to-websocket latency": percentiles([t - taps[c] for c, t in received.items() if c in taps]),
+            "presented-to-websocket latency": percentiles([t - presented[c] for c, t in received.items()])}
+
+
+# badge-registration-server stub, accepts every registration and keeps the time it is received.  The known badges are
+# returned by /api/badge/sync (always a full sync).  delay: seconds, response time of a registration (or a batch).
+# batches: /api/registration/batch is supported, else 404 (the uplink falls back to one request per registration)
+class BadgeServerStub(http.server.BaseHTTPRequestHandler):
+    protocol_version = "HTTP/1.1"
+    wbufsize = -1 # headers and body in one write, no delayed ACK on keep-alive connections
+    received = {}
+    badges = []
+    delay = 0
+    batches = True
+
+    def do_POST(self):
+        body = json.loads(self.rfile.read(int(self.headers["Content-Length"])))
+        if self.path.startswith("/api/registration/batch"):
+            if not self.batches:
+                self.send_error(404)
+                return
+            registrations = body["registrations"]
+        else:
+            registrations = [body]
+        now = time.perf_counter()
+        for registration in registrations:
+            BadgeServerStub.received.setdefault(registration["badge_code"], now)
+        time.sleep(self.delay)
+        if "registrations" in body:
+            self.answer({"status": True, "data": [True] * len(registrations)})
+        else:
+            self.answer({"status": True})
+
+    def do_GET(self):
+        if self.path.startswith("/api/badge/sync"):
+            self.answer({"status": True, "data": [{"badge_code": c, "valid": True} for c in self.badges], "sync": "0", "full": True})
+        else:
+            self.send_error(404)
+
+    def answer(self, data):
+        body = json.dumps(data).encode()
+        self.send_response(200)
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+        self.wfile.flush()
+
+    def log_message(self, *args):
+        pass
+
+
+def import_rfidusb():
+    try:
+        import config
+    except ImportError: # rfidusb.py requires the config.py of the site
+        config = types.ModuleType("config")
+        config.LOG_HANDLE, config.LOG_FILE, config.LOG_LEVEL = "RFID", "rfid-benchmark", "INFO"
+        config.BR_URL, config.BR_KEY, config.RESOLUTION = "", "", "millisecond"
+        sys.modules["config"] = config
+    import rfidusb
+    rfidusb.beep = lambda ok, scanned=None: scanned is not None and feedback_latencies.append(time.perf_counter() - scanned)
+    return rfidusb
+
+
+feedback_latencies = [] # scan to beep (rfidusb.py)
+
+
+# With known badges (badge cache of rfidusb.py), the feedback does not wait for the badge-registration-server.
+# batch_window: milliseconds, batch mode of rfidusb.py (0 is disabled).  batches: the stub supports batches
+def uplink(nbr_readers, nbr_scans, rate, delay=0, known=False, batch_window=0, batches=True):
+    BadgeServerStub.delay = delay
+    BadgeServerStub.batches = batches
+    BadgeServerStub.badges = [f"{i:08x}" for i in range(nbr_scans)] if known else []
+    stub = http.server.ThreadingHTTPServer(("localhost", 0), BadgeServerStub)
+    threading.Thread(target=stub.serve_forever, daemon=True).start()
+    readers = start_readers(nbr_readers)
+    rfidusb = import_rfidusb()
+    server, thread = start_server(free_port(), rfidusb.app) # the readers run on the event loop of the server
+    rfidusb.server.url = f"http://localhost:{stub.server_port}"
+    rfidusb.server.location = "benchmark"
+    rfidusb.server.active = True
+    rfidusb.server.batch_window = batch_window
+    end = time.monotonic() + 10
+    while len([r for r in rfidusb.server.readers_info if r["connected"]]) < nbr_readers and time.monotonic() < end:
+        time.sleep(0.05)
+    time.sleep(0.2) # the readers pick up the settings at their next cycle
+    end = time.monotonic() + 10
+    while known and len(rfidusb.badge_cache.badges) < nbr_scans and time.monotonic() < end:
+        time.sleep(0.05)
+    BadgeServerStub.received = {}
+    feedback_latencies.clear()
+    for i in range(nbr_scans):
+        readers[i % nbr_readers].tap(f"{i:08x}", duration=0.2)
+        time.sleep(1 / rate)
+    end = time.monotonic() + 10
+    while len(BadgeServerStub.received) < nbr_scans and time.monotonic() < end:
+        time.sleep(0.05)
+    stop_readers(readers)
+    server.should_exit = True
+    thread.join()
+    stub.shutdown()
+    taps = {c: t for r in readers for c, t in r.taps.items()}
+    return {"readers": nbr_readers, "scans": nbr_scans, "received": len(BadgeServerStub.received), "server delay": delay,
+            "known badges": known, "batch window": batch_window, "batches": batches and batch_window > 0, "badge cache": rfidusb.badge_cache.stats()["hit_rate"],
+            "scan-to-post latency": percentiles([t - taps[c] for c, t in BadgeServerStub.received.items() if c in taps]),
+            "scan-to-feedback latency": percentiles(feedback_latencies)}
+
+
+# Every badge is presented 1/rate seconds, the next one follows immediately.  A rate is sustainable when (almost) every
+# badge arrives at the websocket client.
+async def throughput(port, rates, seconds):
+    readers = start_readers(1)
+    await wait_for_ws_readers(readers)
+    client = await websockets.connect(f"ws://localhost:{port}/ws", max_queue=None)
+    received = set()
+
+    async def receive():
+        while True:
+            data = json.loads(await client.recv())
+            if "read" in data:
+                received.add(data["read"]["code"])
+
+    receiver = asyncio.create_task(receive())
+    result = {}
+    sustainable = 0
+    for rate_index, rate in enumerate(rates):
+        nbr_scans = int(rate * seconds)
+        codes = [f"{rate_index:02x}{i:06x}" for i in range(nbr_scans)]
+        start = time.perf_counter()
+        for i, code in enumerate(codes):
+            readers[0].tap(code, duration=1 / rate)
+            await asyncio.sleep(max(0, start + (i + 1) / rate - time.perf_counter()))
+        await asyncio.sleep(0.5)
+        ratio = len(received.intersection(codes)) / nbr_scans
+        result[f"{rate} scans/s"] = f"{ratio * 100:.1f}% received"
+        if ratio >= 0.99:
+            sustainable = rate
+    receiver.cancel()
+    await client.close()
+    stop_readers(readers)
+    result["maximum sustainable scans/s"] = sustainable
+    return result
+
+
+# cpu time of the process (server and simulator), without and with readers that are polled
+async def cpu(nbr_readers, seconds):
+    start, cpu_start = time.perf_counter(), time.process_time()
+    await asyncio.sleep(seconds)
+    idle = (time.process_time() - cpu_start) / (time.perf_counter() - start)
+    readers = start_readers(nbr_readers)
+    await wait_for_ws_readers(readers)
+    start, cpu_start, polls = time.perf_counter(), time.process_time(), sum(r.polls for r in readers)
+    await asyncio.sleep(seconds)
+    duration = time.perf_counter() - start
+    busy = (time.process_time() - cpu_start) / duration
+    polls = sum(r.polls for r in readers) - polls
+    stop_readers(readers)
+    return {"readers": nbr_readers, "cpu without readers": f"{idle * 100:.2f}%", f"cpu with {nbr_readers} readers": f"{busy * 100:.2f}%",
+            "cpu per reader (incl. simulator)": f"{(busy - idle) / nbr_readers * 100:.2f}%", "polls/s per reader": round(polls / duration / nbr_readers)}
+
+
+# nbr_edges edges in one process, every edge has its own broadcast hub and uplink to the hub.  Every edge publishes
+# nbr_events events at rate events per second.
+def edge_process(url, first, nbr_edges, nbr_events, rate):
+    async def edge(node):
+        local_hub = ws_server.BroadcastHub()
+        uplink = aggregate.EdgeUplink(local_hub, url, node)
+        task = asyncio.create_task(uplink.run())
+        while not uplink.connected:
+            await asyncio.sleep(0.01)
+        start = time.perf_counter()
+        for i in range(nbr_events):
+            local_hub.publish(({"read": {"code": f"{i:08X}", "sent": time.time()}}, None))
+            await asyncio.sleep(max(0, start + (i + 1) / rate - time.perf_counter()))
+        while uplink.sent_seq != local_hub.seq:
+            await asyncio.sleep(0.01)
+        await asyncio.sleep(1) # until the hub received every event
+        task.cancel()
+
+    async def edges():
+        await asyncio.gather(*[edge(f"edge-{first + i}") for i in range(nbr_edges)])
+
+    asyncio.run(edges())
+
+
+# The events of every edge must arrive at a client of the hub, in order.  The edges run in nbr_processes processes.
+async def aggregation(port, nbr_edges, nbr_processes, nbr_events, rate):
+    client = await websockets.connect(f"ws://localhost:{port}/ws", max_queue=None)
+    received = {} # node: [code, ...]
+    latencies = []
+    total = nbr_edges * nbr_events
+
+    received_times = []
+
+    async def receive():
+        count = 0
+        while count < total:
+            data = json.loads(await client.recv())
+            if "read" in data:
+                received_times.append(time.perf_counter())
+                latencies.append(time.time() - data["read"]["sent"])
+                received.setdefault(data["node"], []).append(data["read"]["code"])
+                count += 1
+
+    receiver = asyncio.create_task(receive())
+    context = multiprocessing.get_context("spawn")
+    if not ws_server.HUB_MODE: # the server is a hub for this benchmark
+        ws_server.app.add_api_websocket_route("/edge", ws_server.edge_endpoint)
+    per_process = -(-nbr_edges // nbr_processes)
+    processes = [context.Process(target=edge_process, args=(f"ws://localhost:{port}/edge", first, min(per_process, nbr_edges - first), nbr_events, rate))
+                 for first in range(0, nbr_edges, per_process)]
+    for process in processes:
+        process.start()
+    while ws_server.edges.stats()["connected"] < nbr_edges:
+        await asyncio.sleep(0.05)
+    cpu_start = time.process_time()
+    try:
+        await asyncio.wait_for(receiver, timeout=nbr_events / rate + 30)
+    except asyncio.TimeoutError:
+        pass
+    cpu = time.process_time() - cpu_start
+    await client.close()
+    for process in processes:
+        process.join(timeout=10)
+    expected = [f"{i:08X}" for i in range(nbr_events)]
+    stats = ws_server.edges.stats()
+    return {"edges": nbr_edges, "processes": nbr_processes, "events per edge": nbr_events, "received": sum(len(c) for c in received.values()),
+            "edges with every event in order": sum(1 for c in received.values() if c == expected),
+            "events/s": round(len(received_times) / (received_times[-1] - received_times[0])) if len(received_times) > 1 else 0,
+            "duplicates": stats["duplicates"], "hub cpu per event (incl. the client)": f"{cpu / max(1, stats['events']) * 1e6:.0f}us",
+            "edge-to-client latency": percentiles(latencies)}
+
+
+# A reader stops answering for stall seconds, while its device node is present.  The watchdog detects it and reopens
+# the port.  The times are seconds since the start of the stall.
+async def recovery(port, stall):
+    readers = start_readers(1)
+    await wait_for_ws_readers(readers)
+    client = await websockets.connect(f"ws://localhost:{port}/ws", max_queue=None)
+    states = []
+    received = []
+
+    async def receive():
+        while True:
+            data = json.loads(await client.recv())
+            if "scanner_state" in data:
+                states.append((time.perf_counter(), data["scanner_state"].get("health")))
+            elif "read" in data:
+                received.append(time.perf_counter())
+
+    receiver = asyncio.create_task(receive())
+    start = time.perf_counter()
+    readers[0].stall(stall)
+    await asyncio.sleep(stall)
+    i = 0
+    while not received and time.perf_counter() - start < stall + 60:
+        readers[0].tap(f"{i:08x}", duration=0.2)
+        i += 1
+        await asyncio.sleep(0.25)
+    receiver.cancel()
+    await client.close()
+    stop_readers(readers)
+    result = {"stall": stall}
+    for t, health in states:
+        result.setdefault(f"{health}", round(t - start, 3))
+    result["first scan after the stall"] = round(received[0] - start - stall, 3) if received else None
+    result["reader"] = [{k: r[k] for k in ("health", "recoveries", "response_rate")} for r in ws_server.reader_manager.stats()]
+    return result
+
+
+# Counts the bytes from the server to the client, i.e. on the wire (websocket framing and compression included)
+class ByteCounter():
+    def __init__(self, target_port):
+        self.target_port = target_port
+        self.received = 0
+
+    async def start(self):
+        self.server = await asyncio.start_server(self.connection, "localhost", 0)
+        return self.server.sockets[0].getsockname()[1]
+
+    async def connection(self, client_reader, client_writer):
+        server_reader, server_writer = await asyncio.open_connection("localhost", self.target_port)
+
+        async def pipe(reader, writer, count):
+            while data := await reader.read(65536):
+                if count:
+                    self.received += len(data)
+                writer.write(data)
+                await writer.drain()
+            writer.close()
+
+        await asyncio.gather(pipe(client_reader, server_writer, False), pipe(server_reader, client_writer, True), return_exceptions=True)
+
+
+def decode(message, subprotocol):
+    if subprotocol is None:
+        return [json.loads(message)]
+    return wire.msgpack.unpackb(message) if subprotocol == "rfid.msgpack" else json.loads(message)
+
+
+# nbr_events scan events to one client, with every wire format, with and without compression.  The cpu time is the time
+# of the server thread.
+async def wire_formats(port, server_thread, nbr_events, rate):
+    cpu_clock = time.pthread_getcpuclockid(server_thread.ident)
+    result = {}
+    for subprotocol in [None, *wire.FORMATS]:
+        for compression in (None, "deflate"):
+            counter = ByteCounter(port)
+            proxy_port = await counter.start()
+            client = await websockets.connect(f"ws://localhost:{proxy_port}/ws", subprotocols=[subprotocol] if subprotocol else None,
+                                              compression=compression, max_queue=None)
+            received, messages = 0, 0
+
+            async def receive():
+                nonlocal received, messages
+                while received < nbr_events:
+                    events = decode(await client.recv(), subprotocol)
+                    messages += 1
+                    received += sum(1 for e in events if "read" in e)
+
+            receiver = asyncio.create_task(receive())
+            await asyncio.sleep(0.1)
+            counter.received = 0
+            cpu_start = time.clock_gettime(cpu_clock)
+            start = time.perf_counter()
+            for i in range(nbr_events):
+                ws_server.event_queue.put({"read": {"timestamp": datetime.datetime.now().isoformat()[:23], "code": f"{i:08x}",
+                                                    "hostname": "benchmark-host", "reader": f"1-1.{i % 4}"}})
+                if i % 20 == 19:
+                    await asyncio.sleep(max(0, start + (i + 1) / rate - time.perf_counter()))
+            try:
+                await asyncio.wait_for(receiver, timeout=30)
+            except asyncio.TimeoutError:
+                pass
+            cpu = time.clock_gettime(cpu_clock) - cpu_start
+            await client.close()
+            counter.server.close()
+            name = f"{subprotocol or 'json'}{' + deflate' if compression else ''}"
+            result[name] = (f"{received} events in {messages} messages, {counter.received / max(1, received):.1f} bytes/event, "
+                            f"server cpu {cpu / max(1, received) * 10000 * 1000:.0f}ms per 10k events")
+    if not wire.msgpack:
+        result["rfid.msgpack"] = "not available, msgpack is not installed"
+    return result
+
+
+def main():
+    parser = argparse.ArgumentParser(description="websocket.py load test and benchmarks")
+    sub = parser.add_subparsers(dest="command", required=True)
+    p = sub.add_parser("broadcast", help="every client must receive every scan")
+    p.add_argument("--clients", type=int, default=200)
+    p.add_argument("--events", type=int, default=100)
+    p.add_argument("--rate", type=float, default=50, help="scans per second, 0 is as fast as possible")
+    p = sub.add_parser("protocol", help="decode speed of the reader protocol, no server required")
+    p.add_argument("--polls", type=int, default=100000)
+    p = sub.add_parser("latency", help="scan to websocket latency")
+    p.add_argument("--readers", type=int, default=2)
+    p.add_argument("--scans", type=int, default=200)
+    p.add_argument("--rate", type=float, default=20, help="scans per second, all readers")
+    p = sub.add_parser("uplink", help="scan to POST and scan to feedback latency (rfidusb.py)")
+    p.add_argument("--readers", type=int, default=2)
+    p.add_argument("--scans", type=int, default=200)
+    p.add_argument("--rate", type=float, default=20, help="scans per second, all readers")
+    p.add_argument("--delay", type=float, default=0, help="milliseconds, response time of the badge-registration-server")
+    p.add_argument("--known", action="store_true", help="the badges are known in advance (badge cache)")
+    p.add_argument("--batch", type=int, default=0, help="milliseconds, batch window of rfidusb.py, 0 is no batches")
+    p.add_argument("--no-batch-api", action="store_true", help="the badge-registration-server does not support batches")
+    p = sub.add_parser("throughput", help="maximum sustainable scans per second of one reader")
+    p.add_argument("--rates", default="5,10,20,40,80", help="comma separated, scans per second")
+    p.add_argument("--seconds", type=float, default=3, help="per rate")
+    p = sub.add_parser("cpu", help="cpu usage per reader")
+    p.add_argument("--readers", type=int, default=4)
+    p.add_argument("--seconds", type=float, default=5)
+    p = sub.add_parser("aggregate", help="edges in separate processes forward their events to a hub")
+    p.add_argument("--edges", type=int, default=100)
+    p.add_argument("--processes", type=int, default=4)
+    p.add_argument("--events", type=int, default=100, help="per edge")
+    p.add_argument("--rate", type=float, default=20, help="events per second, per edge")
+    p = sub.add_parser("wire", help="bytes on the wire and cpu of the websocket wire formats")
+    p.add_argument("--events", type=int, default=10000)
+    p.add_argument("--rate", type=float, default=2000, help="events per second")
+    p = sub.add_parser("recovery", help="a stalled reader is detected and reopened")
+    p.add_argument("--stall", type=float, default=5, help="seconds the reader does not answer")
+    sub.add_parser("all", help="all benchmarks, default settings")
+    args = parser.parse_args()
+    commands = ["protocol", "broadcast", "latency", "throughput", "cpu", "aggregate", "wire", "recovery", "uplink"] if args.command == "all" else [args.command]
+    defaults = {c: vars(sub.choices[c].parse_args([])) for c in commands}
+    ok = True
+
+    if "protocol" in commands:
+        a = args if args.command == "protocol" else argparse.Namespace(**defaults["protocol"])
+        print_result("protocol", protocol_poll(a.polls))
+
+    server_commands = [c for c in commands if c in ("broadcast", "latency", "throughput", "cpu", "aggregate", "wire", "recovery")]
+    if server_commands:
+        port = free_port()
+        server, thread = start_server(port)
+        try:
+            for command in server_commands:
+                a = args if args.command == command else argparse.Namespace(**defaults[command])
+                if command == "broadcast":
+                    result = asyncio.run(broadcast(port, a.clients, a.events, a.rate))
+                    ok &= result["clients with every event in order"] == a.clients
+                elif command == "latency":
+                    result = asyncio.run(latency(port, a.readers, a.scans, a.rate))
+                elif command == "aggregate":
+                    result = asyncio.run(aggregation(port, a.edges, a.processes, a.events, a.rate))
+                    ok &= result["edges with every event in order"] == a.edges
+                elif command == "wire":
+                    result = asyncio.run(wire_formats(port, thread, a.events, a.rate))
+                elif command == "recovery":
+                    result = asyncio.run(recovery(port, a.stall))
+                elif command == "throughput":
+                    result = asyncio.run(throughput(port, [float(r) for r in a.rates.split(",")], a.seconds))
+                else:
+                    result = asyncio.run(cpu(a.readers, a.seconds))
+                print_result(command, result)
+        finally:
+            server.should_exit = True
+            thread.join(timeout=5)
+
+    if "uplink" in commands: # last, imports rfidusb.py (and a config.py)
+        a = args if args.command == "uplink" else argparse.Namespace(**defaults["uplink"])
+        print_result("uplink", uplink(a.readers, a.scans, a.rate, a.delay / 1000, a.known, a.batch, not a.no_batch_api))
+    sys.stdout.flush()
+    sys.exit(0 if ok else 1)
+
+
+if __name__ == "__main__":
+    main()
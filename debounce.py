@@ -0,0 +1,35 @@
+# Suppression of repeated scans of the same badge.  A badge is accepted when it was not accepted during the last window
+# seconds, on any reader (the cache is shared by the readers).  Interleaved badges (A, B, A) are handled as well.
+# Memory is bounded: entries older than the window are removed, and at most maxlen badges are remembered (least
+# recently accepted are removed first).  Both are amortized O(1) per scan.
+
+import collections, threading, time
+
+
+class DebounceCache():
+    def __init__(self, window=2, maxlen=10000):
+        self.window = window # seconds
+        self.maxlen = maxlen
+        self.accepted = collections.OrderedDict() # code: time.monotonic() of acceptance, oldest first
+        self.lock = threading.Lock()
+
+    # returns True if the badge is accepted, False if it is a repeated scan
+    def accept(self, code, now=None):
+        if now is None:
+            now = time.monotonic()
+        with self.lock:
+            last = self.accepted.get(code)
+            if last is not None and now - last < self.window:
+                return False
+            self.accepted[code] = now
+            self.accepted.move_to_end(code)
+            # remove expired entries, they are at the front
+            while self.accepted:
+                oldest_code, oldest = next(iter(self.accepted.items()))
+                if now - oldest < self.window and len(self.accepted) <= self.maxlen:
+                    break
+                del self.accepted[oldest_code]
+            return True
+
+    def __len__(self):
+        return len(self.accepted)
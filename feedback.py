@@ -0,0 +1,146 @@
+# Audio feedback (beeps) for the person that presents a badge.  The beeps are played by a worker thread, play() only
+# queues a command, i.e. the poll threads, uplink workers and the event loop never wait for a sound to finish.
+# A burst of the same command is played once, and a command that waited too long is dropped: a beep only makes sense
+# right after the badge is presented.
+#
+# linux: the pc speaker, via its input device (pcspkr module, the user must be in the input group) or via the console.
+# windows: winsound.
+
+import collections, glob, os, struct, sys, threading, time
+
+os_linux = "linux" in sys.platform
+if os_linux:
+    import fcntl
+winsound = None # windows, imported when the feedback worker is started
+
+# pattern: [(frequency in Hz, duration in seconds), ...], a frequency of 0 is a pause
+PATTERNS = {
+    "ok": [(1500, 0.2)],
+    "error": [(1500, 0.8)],
+}
+
+EV_SND = 0x12
+SND_TONE = 0x02
+KIOCSOUND = 0x4B2F
+CLOCK_TICK_RATE = 1193180
+PCSPKR_DEVICES = "/dev/input/by-path/*-event-spkr"
+CONSOLE_DEVICES = ("/dev/console", "/dev/tty0")
+
+
+# the pc speaker as input device, the same as the beep utility uses
+class EvdevSpeaker():
+    name = "evdev"
+
+    def __init__(self):
+        self.fd = None
+        for device in glob.glob(PCSPKR_DEVICES):
+            self.fd = os.open(device, os.O_WRONLY)
+            break
+        if self.fd is None:
+            raise OSError(f"no pc speaker device {PCSPKR_DEVICES}")
+
+    def tone(self, frequency):
+        os.write(self.fd, struct.pack("llHHi", 0, 0, EV_SND, SND_TONE, frequency))
+
+
+class ConsoleSpeaker():
+    name = "console"
+
+    def __init__(self):
+        self.fd = None
+        errors = []
+        for device in CONSOLE_DEVICES:
+            try:
+                fd = os.open(device, os.O_WRONLY)
+                fcntl.ioctl(fd, KIOCSOUND, 0)
+                self.fd = fd
+                break
+            except OSError as e:
+                errors.append(f"{device}: {e}")
+        if self.fd is None:
+            raise OSError(", ".join(errors))
+
+    def tone(self, frequency):
+        fcntl.ioctl(self.fd, KIOCSOUND, CLOCK_TICK_RATE // frequency if frequency else 0)
+
+
+class Feedback():
+    def __init__(self, maxlen=4, stale=2):
+        self.maxlen = maxlen # number of queued commands, the oldest is dropped when the queue is full
+        self.stale = stale # seconds, a command that is older is dropped
+        self.commands = collections.deque(maxlen=maxlen) # (pattern, time.perf_counter() of the scan)
+        self.condition = threading.Condition()
+        self.speaker = None
+        self.backend = "none"
+        self.error = None # why there is no speaker, or the last error while playing
+        self.played_ctr = 0
+        self.coalesced_ctr = 0
+        self.dropped_ctr = 0
+        self.thread = None
+
+    def start(self):
+        self.open_speaker()
+        self.thread = threading.Thread(target=self.run, daemon=True, name="feedback")
+        self.thread.start()
+
+    # queue a pattern (see PATTERNS), returns immediately.  scanned is the time.perf_counter() of the scan, the default
+    # is now.
+    def play(self, pattern, scanned=None):
+        if scanned is None:
+            scanned = time.perf_counter()
+        with self.condition:
+            if self.commands and self.commands[-1][0] == pattern:
+                self.coalesced_ctr += 1
+                return
+            if len(self.commands) == self.maxlen:
+                self.dropped_ctr += 1
+            self.commands.append((pattern, scanned))
+            self.condition.notify()
+
+    def open_speaker(self):
+        global winsound
+        if not os_linux:
+            import winsound
+            self.backend = "winsound"
+            return
+        errors = []
+        for speaker in (EvdevSpeaker, ConsoleSpeaker):
+            try:
+                self.speaker = speaker()
+                self.backend = speaker.name
+                return
+            except OSError as e:
+                errors.append(f"{speaker.name}: {e}")
+        self.error = ", ".join(errors)
+
+    def tone(self, frequency, duration):
+        if self.speaker:
+            self.speaker.tone(frequency)
+            time.sleep(duration)
+            self.speaker.tone(0)
+        elif self.backend == "winsound":
+            if frequency:
+                winsound.Beep(frequency, int(duration * 1000))
+            else:
+                time.sleep(duration)
+
+    def run(self):
+        while True:
+            with self.condition:
+                while not self.commands:
+                    self.condition.wait()
+                pattern, scanned = self.commands.popleft()
+            if time.perf_counter() - scanned > self.stale:
+                self.dropped_ctr += 1
+                continue
+            try:
+                for frequency, duration in PATTERNS[pattern]:
+                    self.tone(frequency, duration)
+                self.played_ctr += 1
+            except Exception as e:
+                self.error = f"{pattern}: {e}"
+
+    def stats(self):
+        with self.condition:
+            return {"backend": self.backend, "queued": len(self.commands), "played": self.played_ctr,
+                    "coalesced": self.coalesced_ctr, "dropped": self.dropped_ctr, "error": self.error}
@@ -0,0 +1,94 @@
+# Health of a reader.  A CH340 adapter can get into a bad state where the device node is still present (the hotplug
+# detection sees nothing) but the reader does not answer anymore: every read returns nothing or raises an exception.
+#
+# Every poll is a request to the reader, a healthy reader answers every poll (with or without a badge).  The health
+# counts the polls that got no answer in a row (streak).  When the reader did not answer for stall_timeout seconds, it
+# is stalled: the poll loop closes the port, opens it again and starts with a new driver (recovery).  The recoveries of
+# a reader that keeps stalling are spread out, see backoff().
+# When a reader is not polled (not active, no location), it is probed every probe_interval seconds: the same request,
+# the answer is ignored.  The silence of a reader is measured from its last answer, or from the moment the polling
+# resumed: the time in between probes does not count.  A reader that is probed is stalled when probe_stall probes in a
+# row got no answer.
+#
+# states: ok, degraded (no answer for degraded_after seconds), stalled, recovering (until the first answer after the
+# recovery).  A single missed poll (e.g. a slow response) does not change the state: every change is logged and broadcast.
+
+import time
+
+OK, DEGRADED, STALLED, RECOVERING = "ok", "degraded", "stalled", "recovering"
+
+
+class ReaderHealth():
+    def __init__(self, stall_timeout=3, probe_interval=5, backoff_max=30, degraded_after=1, probe_stall=3):
+        self.stall_timeout = stall_timeout # seconds
+        self.degraded_after = degraded_after # seconds
+        self.probe_stall = probe_stall # probes in a row without an answer
+        self.probe_interval = probe_interval # seconds
+        self.backoff_max = backoff_max # seconds
+        self.state = OK
+        self.streak = 0 # polls in a row without an answer
+        self.last_answer = time.monotonic()
+        self.last_poll = 0
+        self.resumed = 0 # the polling resumed after a pause (e.g. probes only), monotonic
+        self.response_rate = 1.0 # moving average of the polls with an answer
+        self.poll_ctr = 0
+        self.error_ctr = 0
+        self.recovery_ctr = 0
+        self.failed_recoveries = 0 # in a row, the reader stalled again right after a recovery
+        self.error = None # the last exception
+
+    # returns True when the state changed
+    def record(self, answered, error=None):
+        now = time.monotonic()
+        probed = now - self.last_poll >= self.degraded_after # not polled in between
+        if probed:
+            self.resumed = now
+        self.poll_ctr += 1
+        self.last_poll = now
+        self.response_rate = 0.95 * self.response_rate + 0.05 * answered
+        if error is not None:
+            self.error_ctr += 1
+            self.error = str(error)
+        if answered:
+            self.streak = 0
+            self.last_answer = now
+            self.failed_recoveries = 0
+            return self.set_state(OK)
+        self.streak += 1
+        silence = now - max(self.last_answer, self.resumed)
+        if silence >= self.stall_timeout or (probed and self.streak >= self.probe_stall):
+            return self.set_state(STALLED)
+        if self.state == RECOVERING or silence < self.degraded_after:
+            return False
+        return self.set_state(DEGRADED)
+
+    def set_state(self, state):
+        changed = state != self.state
+        self.state = state
+        return changed
+
+    @property
+    def stalled(self):
+        return self.state == STALLED
+
+    def probe_due(self):
+        return time.monotonic() - self.last_poll >= self.probe_interval
+
+    # seconds to wait before the port is opened again: 0 at the first recovery, then 1, 2, 4, ... up to backoff_max
+    def backoff(self):
+        return min(self.backoff_max, 2 ** (self.failed_recoveries - 2)) if self.failed_recoveries > 1 else 0
+
+    def recovering(self):
+        self.recovery_ctr += 1
+        self.failed_recoveries += 1
+        return self.set_state(RECOVERING)
+
+    # the port is open again, the stall timeout starts over.  The state is ok at the first answer.
+    def reopened(self):
+        self.streak = 0
+        self.last_answer = self.resumed = time.monotonic()
+
+    def stats(self):
+        return {"health": self.state, "streak": self.streak, "response_rate": round(self.response_rate, 3),
+                "last_answer_age": round(time.monotonic() - self.last_answer, 3), "polls": self.poll_ctr,
+                "errors": self.error_ctr, "recoveries": self.recovery_ctr, "error": self.error}
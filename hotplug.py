@@ -0,0 +1,103 @@
+# Detection of RFID readers that are attached to or detached from the USB ports.
+# On linux, /dev is watched with inotify, i.e. a new reader is detected as soon as its device node appears.
+# On other systems (or when inotify is not available), the ports are polled.
+
+import asyncio, ctypes, ctypes.util, os, struct, sys
+
+os_linux = "linux" in sys.platform
+
+IN_ATTRIB = 0x00000004
+IN_CREATE = 0x00000100
+IN_DELETE = 0x00000200
+IN_NONBLOCK = 0x00000800
+IN_CLOEXEC = 0x00080000
+DEVICE_PREFIXES = (b"ttyUSB", b"ttyACM")
+
+# readers emulated by simulator.py, {reader_id: port_name}.  Another process can pass them in the environment variable
+# RFID_SIMULATED_READERS, e.g. "sim-1=/dev/pts/3,sim-2=/dev/pts/4"
+SIMULATED_READERS = dict(r.split("=", 1) for r in os.environ.get("RFID_SIMULATED_READERS", "").split(",") if "=" in r)
+
+
+# find all attached RFID readers, returns {reader_id: port_name}.  The reader id is the USB location (if available),
+# i.e. it does not change when the reader is reattached to the same USB port.
+def find_readers():
+    import serial.tools.list_ports as port_list # not at startup
+    if os_linux:
+        ports = [p for p in port_list.comports() if "usb" in p.name.lower()]
+    else:
+        ports = [p for p in port_list.comports() if "ch340" in p.description.lower()]
+    return {**{p.location or p.name: p.device for p in ports}, **SIMULATED_READERS}
+
+
+class HotplugWatcher():
+    def __init__(self, path="/dev"):
+        self.fd = None
+        self.mode = "polling"
+        self.error = None
+        if os_linux:
+            try:
+                libc = ctypes.CDLL(ctypes.util.find_library("c"), use_errno=True)
+                fd = libc.inotify_init1(IN_NONBLOCK | IN_CLOEXEC)
+                if fd < 0:
+                    raise OSError(ctypes.get_errno(), "inotify_init1")
+                if libc.inotify_add_watch(fd, path.encode(), IN_CREATE | IN_DELETE | IN_ATTRIB) < 0:
+                    os.close(fd)
+                    raise OSError(ctypes.get_errno(), "inotify_add_watch")
+                self.fd = fd
+                self.mode = "inotify"
+            except Exception as e:
+                self.error = e
+
+    # wait until a serial device node is created, deleted or changed (e.g. permissions are set by udev) or until the
+    # timeout expires, on the event loop.  Returns True when there was a change.
+    async def wait_async(self, timeout):
+        if self.fd is None:
+            await asyncio.sleep(timeout)
+            return False
+        loop = asyncio.get_running_loop()
+        end = loop.time() + timeout
+        while True:
+            remaining = end - loop.time()
+            if remaining <= 0:
+                return False
+            readable = loop.create_future()
+            loop.add_reader(self.fd, lambda: readable.done() or readable.set_result(True))
+            try:
+                await asyncio.wait_for(readable, remaining)
+            except asyncio.TimeoutError:
+                return False
+            finally:
+                loop.remove_reader(self.fd)
+            if self.__read_events():
+                await asyncio.sleep(0.02) # a device generates a few events in a row, handle them at once
+                self.__read_events()
+                return True
+
+    def __read_events(self):
+        try:
+            data = os.read(self.fd, 4096)
+        except BlockingIOError:
+            return False
+        changed = False
+        offset = 0
+        while offset + 16 <= len(data):
+            wd, mask, cookie, length = struct.unpack_from("iIII", data, offset)
+            name = data[offset + 16: offset + 16 + length].rstrip(b"\0")
+            changed |= name.startswith(DEVICE_PREFIXES)
+            offset += 16 + length
+        return changed
+
+    def close(self):
+        if self.fd is not None:
+            os.close(self.fd)
+            self.fd = None
+
+
+# Delays between the attempts to open a port that just appeared.  The port is not always accessible immediately, start
+# with a short delay and double it, up to 1 second.  In total about 10 seconds.
+def open_delays(first=0.01, maximum=1, total=10):
+    delay, elapsed = first, 0
+    while elapsed < total:
+        yield delay
+        elapsed += delay
+        delay = min(delay * 2, maximum)
@@ -0,0 +1,219 @@
+# Journal of the scans: every scan is a fixed size binary record, appended to a memory mapped segment file.  Queries by
+# time range (sparse time index) and by badge (badge index), e.g. who was scanned at location X between 08:00 and 08:15.
+#
+# directory: names.json (location and reader names, a record contains the number of the name), 000001.jnl, 000002.jnl, ...
+# A segment has a fixed size: a header (magic, number of records) and the records.  When a segment is full, the next one
+# is created (rollover) and its badge index is saved in 000001.idx.  Only the newest max_segments segments are kept.
+# A record: time (ms since epoch), location, reader, upload status, length of the uid, uid (at most 10 bytes).
+# The time index contains the time of every TIME_INDEX_STEP-th record, i.e. a query by time reads a few records more
+# than required.  The records are appended in time order (unless the clock is set back).
+
+import array, bisect, collections, json, mmap, os, pickle, struct, threading, time
+
+RECORD = struct.Struct("<QHHBB10s")
+HEADER = struct.Struct("<8sQ")
+HEADER_SIZE = 64
+MAGIC = b"RFIDJNL1"
+STATUS_OFFSET = 12 # in a record
+TIME_INDEX_STEP = 256
+
+PENDING, OK, REJECTED, FAILED = 0, 1, 2, 3
+STATUS_NAMES = {PENDING: "pending", OK: "ok", REJECTED: "rejected", FAILED: "failed"}
+
+
+class Segment():
+    def __init__(self, path, size=0):
+        self.path = path
+        if not os.path.exists(path):
+            with open(path, "wb") as f:
+                f.truncate(size)
+                f.write(HEADER.pack(MAGIC, 0))
+        with open(path, "r+b") as f:
+            self.mm = mmap.mmap(f.fileno(), 0)
+        magic, self.count = HEADER.unpack_from(self.mm, 0)
+        if magic != MAGIC:
+            raise ValueError(f"{path} is not a journal segment")
+        self.capacity = (len(self.mm) - HEADER_SIZE) // RECORD.size
+        self.times = [self.time(n) for n in range(0, self.count, TIME_INDEX_STEP)]
+        self.badges = None # uid: array of record numbers, None when not loaded yet
+
+    @property
+    def index_path(self):
+        return self.path[:-4] + ".idx"
+
+    def time(self, n):
+        return struct.unpack_from("<Q", self.mm, HEADER_SIZE + n * RECORD.size)[0]
+
+    def record(self, n):
+        return RECORD.unpack_from(self.mm, HEADER_SIZE + n * RECORD.size)
+
+    def append(self, time_ms, location, reader, uid):
+        n = self.count
+        RECORD.pack_into(self.mm, HEADER_SIZE + n * RECORD.size, time_ms, location, reader, PENDING, len(uid), uid)
+        self.count = n + 1
+        HEADER.pack_into(self.mm, 0, MAGIC, self.count)
+        if n % TIME_INDEX_STEP == 0:
+            self.times.append(time_ms)
+        if self.badges is not None:
+            self.badges.setdefault(uid, array.array("I")).append(n)
+        return n
+
+    def set_status(self, n, status):
+        self.mm[HEADER_SIZE + n * RECORD.size + STATUS_OFFSET] = status
+
+    def load_badges(self):
+        if self.badges is None:
+            if os.path.exists(self.index_path):
+                with open(self.index_path, "rb") as f:
+                    self.badges = pickle.load(f)
+            else:
+                badges = {}
+                for n, (_, _, _, _, length, uid) in enumerate(RECORD.iter_unpack(self.mm[HEADER_SIZE: HEADER_SIZE + self.count * RECORD.size])):
+                    badges.setdefault(uid[:length], array.array("I")).append(n)
+                self.badges = badges
+        return self.badges
+
+    def save_badges(self):
+        with open(self.index_path + ".tmp", "wb") as f:
+            pickle.dump(self.load_badges(), f)
+        os.replace(self.index_path + ".tmp", self.index_path)
+
+    # record numbers with a time in [start, end)
+    def range(self, start, end):
+        if not self.count or self.times[0] >= end or self.time(self.count - 1) < start:
+            return
+        n = max(0, bisect.bisect_left(self.times, start) - 1) * TIME_INDEX_STEP
+        for n in range(n, self.count):
+            t = self.time(n)
+            if t >= end:
+                return
+            if t >= start:
+                yield n
+
+    def close(self):
+        self.mm.close()
+
+
+class Journal():
+    def __init__(self, path="journal", segment_size=16 * 1024 * 1024, max_segments=16, pending_max=10000):
+        self.path = path
+        self.segment_size = segment_size
+        self.max_segments = max_segments
+        self.pending_max = pending_max
+        self.lock = threading.Lock()
+        os.makedirs(path, exist_ok=True)
+        self.names_path = os.path.join(path, "names.json")
+        self.names = json.load(open(self.names_path)) if os.path.exists(self.names_path) else []
+        self.name_ids = {name: i for i, name in enumerate(self.names)}
+        self.segments = collections.OrderedDict() # number: Segment, oldest first
+        for name in sorted(f for f in os.listdir(path) if f.endswith(".jnl")):
+            self.segments[int(name[:-4])] = Segment(os.path.join(path, name))
+        if not self.segments:
+            self.segments[1] = Segment(self.segment_path(1), self.segment_size)
+        self.active.load_badges()
+        self.pending = collections.OrderedDict() # key: (segment number, record number), until the upload status is known
+        self.append_ctr = 0
+        self.query_ctr = 0 # running queries, these read the segments without the lock
+        self.retired = [] # removed segments, closed when no query is running
+
+    @property
+    def active(self):
+        return next(reversed(self.segments.values()))
+
+    def segment_path(self, number):
+        return os.path.join(self.path, f"{number:06d}.jnl")
+
+    def name_id(self, name):
+        name = name or ""
+        if name not in self.name_ids:
+            self.name_ids[name] = len(self.names)
+            self.names.append(name)
+            with open(self.names_path + ".tmp", "w") as f:
+                json.dump(self.names, f)
+            os.replace(self.names_path + ".tmp", self.names_path)
+        return self.name_ids[name]
+
+    # code: hex string.  key: to set the upload status later, see set_status
+    def append(self, code, location, reader, key=None, timestamp=None):
+        uid = bytes.fromhex(code)[:10]
+        time_ms = int((timestamp or time.time()) * 1000)
+        with self.lock:
+            if self.active.count >= self.active.capacity:
+                self.rollover()
+            number = next(reversed(self.segments))
+            n = self.active.append(time_ms, self.name_id(location), self.name_id(reader), uid)
+            self.append_ctr += 1
+            if key is not None:
+                self.pending[key] = (number, n)
+                while len(self.pending) > self.pending_max:
+                    self.pending.popitem(last=False)
+
+    def set_status(self, key, status):
+        with self.lock:
+            position = self.pending.pop(key, None)
+            if position and position[0] in self.segments:
+                self.segments[position[0]].set_status(position[1], status)
+
+    # the badge index of the full segment is saved by a separate thread, the oldest segments are removed
+    def rollover(self):
+        full = self.active
+        number = next(reversed(self.segments)) + 1
+        self.segments[number] = Segment(self.segment_path(number), self.segment_size)
+        self.segments[number].load_badges()
+        threading.Thread(target=full.save_badges, daemon=True, name="journal-index").start()
+        while len(self.segments) > self.max_segments:
+            _, segment = self.segments.popitem(last=False)
+            self.retired.append(segment)
+        if not self.query_ctr:
+            self.remove_retired()
+
+    # with the lock
+    def remove_retired(self):
+        for segment in self.retired:
+            segment.close()
+            for path in (segment.path, segment.index_path):
+                if os.path.exists(path):
+                    os.remove(path)
+        self.retired = []
+
+    # start, end: seconds since epoch (None is unlimited).  Returns the matching records as dicts, oldest first.
+    # A segment that is removed by a rollover during the query, is closed when the query is finished.
+    def query(self, start=None, end=None, location=None, badge=None, limit=1000):
+        start_ms = int(start * 1000) if start is not None else 0
+        end_ms = int(end * 1000) if end is not None else 2 ** 64
+        with self.lock:
+            segments = list(self.segments.values())
+            names = list(self.names)
+            location_id = self.name_ids.get(location, -1) if location is not None else None
+            self.query_ctr += 1
+        try:
+            if location_id != -1:
+                yield from self.read(segments, names, start_ms, end_ms, location_id, badge, limit)
+        finally:
+            with self.lock:
+                self.query_ctr -= 1
+                if not self.query_ctr:
+                    self.remove_retired()
+
+    def read(self, segments, names, start_ms, end_ms, location_id, badge, limit):
+        uid = bytes.fromhex(badge)[:10] if badge else None
+        for segment in segments:
+            if uid is not None:
+                numbers = (n for n in segment.load_badges().get(uid, ()) if start_ms <= segment.time(n) < end_ms)
+            else:
+                numbers = segment.range(start_ms, end_ms)
+            for n in numbers:
+                time_ms, location_nbr, reader_nbr, status, length, record_uid = segment.record(n)
+                if location_id is not None and location_nbr != location_id:
+                    continue
+                yield {"time": time_ms / 1000, "badge_code": record_uid[:length].hex(), "location": names[location_nbr],
+                       "reader": names[reader_nbr], "status": STATUS_NAMES.get(status, status)}
+                limit -= 1
+                if limit <= 0:
+                    return
+
+    def stats(self):
+        with self.lock:
+            segments = list(self.segments.values())
+            return {"segments": len(segments), "records": sum(s.count for s in segments), "active_capacity": self.active.capacity,
+                    "active_count": self.active.count, "appended": self.append_ctr, "pending": len(self.pending)}
@@ -0,0 +1,70 @@
+# Logging without disk I/O in the poll threads and on the event loop.  A log call only puts the record in a queue, a
+# listener thread formats the records and writes them to the (rotating) log file.  A slow SD card or a log rotation
+# delays the listener, not the caller.  When the queue is full, records are dropped (and counted) instead of waiting.
+#
+# Formats: "text" (the classic format) or "json" (one compact json object per line).
+
+import atexit, json, logging, queue, threading, time
+from logging.handlers import QueueHandler, QueueListener, RotatingFileHandler
+
+TEXT_FORMAT = '%(asctime)s - %(levelname)s - %(name)s - %(message)s'
+
+
+class JsonFormatter(logging.Formatter):
+    def format(self, record):
+        entry = {"time": round(record.created, 3), "level": record.levelname, "logger": record.name,
+                 "thread": record.threadName, "message": record.getMessage()}
+        if record.exc_info:
+            entry["exception"] = self.formatException(record.exc_info)
+        return json.dumps(entry, separators=(",", ":"), default=str)
+
+
+# The record is queued as is, the message is formatted by the listener.  The standard QueueHandler formats the message
+# in the thread that logs.
+class NonBlockingQueueHandler(QueueHandler):
+    def __init__(self, log_queue):
+        super().__init__(log_queue)
+        self.dropped_ctr = 0
+
+    def prepare(self, record):
+        return record
+
+    def enqueue(self, record):
+        try:
+            self.queue.put_nowait(record)
+        except queue.Full:
+            self.dropped_ctr += 1
+
+
+# Allows at most one log call per interval seconds, e.g. to log every received frame at debug level.  The suppressed
+# calls are counted.
+class Sampler():
+    def __init__(self, interval=1):
+        self.interval = interval
+        self.next = 0
+        self.suppressed_ctr = 0
+        self.lock = threading.Lock()
+
+    def allow(self):
+        now = time.monotonic()
+        with self.lock:
+            if now < self.next:
+                self.suppressed_ctr += 1
+                return False
+            self.next = now + self.interval
+            return True
+
+
+# Returns the logger and the queue handler (for the number of dropped records).  The listener is stopped, i.e. the
+# queue is written to the file, when the process exits.
+def setup_logging(name, filename, level="INFO", format="text", maxlen=10000):
+    log = logging.getLogger(name)
+    log.setLevel(getattr(logging, level, logging.INFO))
+    file_handler = RotatingFileHandler(filename, maxBytes=1024 * 1024, backupCount=20)
+    file_handler.setFormatter(JsonFormatter() if format == "json" else logging.Formatter(TEXT_FORMAT))
+    queue_handler = NonBlockingQueueHandler(queue.Queue(maxlen))
+    log.addHandler(queue_handler)
+    listener = QueueListener(queue_handler.queue, file_handler)
+    listener.start()
+    atexit.register(listener.stop)
+    return log, queue_handler
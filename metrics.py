@@ -0,0 +1,133 @@
+# Metrics in the prometheus text format, see the /metrics endpoints.
+# The serial threads update the metrics every poll, therefore updates do not lock and do not allocate: every thread has
+# its own shard (a list of numbers, created at the first update), the shards are added up when the metrics are exposed.
+
+import bisect, threading
+
+# seconds
+LATENCY_BUCKETS = (0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10)
+
+
+class Metric():
+    type = ""
+
+    def __init__(self, registry, name, help, size=1):
+        self.name = name
+        self.help = help
+        self.size = size
+        self.local = threading.local()
+        self.shards = []
+        self.lock = threading.Lock() # only used when a thread creates its shard
+        registry.metrics.append(self)
+
+    def shard(self):
+        try:
+            return self.local.shard
+        except AttributeError:
+            shard = self.local.shard = [0] * self.size
+            with self.lock:
+                self.shards.append(shard)
+            return shard
+
+    def total(self):
+        with self.lock:
+            shards = list(self.shards)
+        return [sum(values) for values in zip(*shards)] if shards else [0] * self.size
+
+    def expose(self):
+        return [f"# HELP {self.name} {self.help}", f"# TYPE {self.name} {self.type}"] + self.samples()
+
+
+class Counter(Metric):
+    type = "counter"
+
+    def inc(self, value=1):
+        self.shard()[0] += value
+
+    def samples(self):
+        return [f"{self.name} {self.total()[0]}"]
+
+
+# A counter per label value, e.g. the http status code.  A child counter is created at the first use of a value.
+class LabeledCounter(Metric):
+    type = "counter"
+
+    def __init__(self, registry, name, help, label):
+        super().__init__(registry, name, help, size=0)
+        self.label = label
+        self.children = {}
+
+    def labels(self, value):
+        child = self.children.get(value)
+        if child is None:
+            with self.lock:
+                child = self.children.setdefault(value, Counter(Registry(), self.name, self.help))
+        return child
+
+    def samples(self):
+        return [f'{self.name}{{{self.label}="{value}"}} {child.total()[0]}' for value, child in list(self.children.items())]
+
+
+# The value is returned by a function, e.g. the number of connected clients.  Also used for counters that are kept
+# elsewhere (type="counter").
+class Gauge(Metric):
+    type = "gauge"
+
+    def __init__(self, registry, name, help, function, type="gauge"):
+        super().__init__(registry, name, help, size=0)
+        self.function = function
+        self.type = type
+
+    def samples(self):
+        return [f"{self.name} {self.function()}"]
+
+
+class Histogram(Metric):
+    type = "histogram"
+
+    # shard: a counter per bucket, +Inf, sum
+    def __init__(self, registry, name, help, buckets=LATENCY_BUCKETS):
+        super().__init__(registry, name, help, size=len(buckets) + 2)
+        self.buckets = buckets
+
+    def observe(self, value):
+        shard = self.shard()
+        shard[bisect.bisect_left(self.buckets, value)] += 1
+        shard[-1] += value
+
+    def samples(self):
+        total = self.total()
+        samples = []
+        cumulative = 0
+        for bucket, count in zip(self.buckets + ("+Inf",), total):
+            cumulative += count
+            samples.append(f'{self.name}_bucket{{le="{bucket}"}} {cumulative}')
+        samples.append(f"{self.name}_sum {total[-1]}")
+        samples.append(f"{self.name}_count {cumulative}")
+        return samples
+
+
+class Registry():
+    def __init__(self):
+        self.metrics = []
+
+    def counter(self, name, help):
+        return Counter(self, name, help)
+
+    def labeled_counter(self, name, help, label):
+        return LabeledCounter(self, name, help, label)
+
+    def gauge(self, name, help, function, type="gauge"):
+        return Gauge(self, name, help, function, type)
+
+    def histogram(self, name, help, buckets=LATENCY_BUCKETS):
+        return Histogram(self, name, help, buckets)
+
+    def expose(self):
+        lines = []
+        for metric in self.metrics:
+            lines += metric.expose()
+        return "\n".join(lines) + "\n"
+
+
+CONTENT_TYPE = "text/plain; version=0.0.4; charset=utf-8"
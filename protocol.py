@@ -0,0 +1,147 @@
+# Serial protocol of the RFID readers.  Every reader model has a driver, see DRIVERS.
+#
+# 7941W
+# command:  AB BA <address> <command> <length> <data> <checksum>
+# response: CD DC <address> <status> <length> <data> <checksum>
+# The checksum is the XOR of address, command/status, length and data.
+# E.g. read uid: AB BA 00 10 00 10, response CD DC 00 81 04 <4 bytes uid> <checksum> or CD DC 00 80 00 80 (no badge)
+
+COMMAND_HEADER = b"\xab\xba"
+RESPONSE_HEADER = b"\xcd\xdc"
+HEADER_LEN = 5 # CD DC address status length
+MAX_DATA_LEN = 32
+
+
+def checksum(data):
+    cs = 0
+    for b in data:
+        cs ^= b
+    return cs
+
+
+def command(cmd, data=b"", address=0):
+    body = bytes([address, cmd, len(data)]) + data
+    return COMMAND_HEADER + body + bytes([checksum(body)])
+
+
+# Decodes the response frames from the bytes received from the serial port.  Reads exactly the number of bytes required
+# to complete a frame, i.e. it returns as soon as a frame is received instead of waiting for the serial timeout.
+# Garbage, partial frames and frames with a wrong checksum are skipped, the decoder resynchronizes on the next header.
+class FrameDecoder():
+    def __init__(self):
+        self.buffer = bytearray()
+        self.garbage_ctr = 0 # number of bytes skipped
+
+    # drop the bytes that are received before a command is sent, e.g. a response that arrived after the timeout of the
+    # previous poll.  Else every next poll would decode the response to the poll before it.
+    def discard(self, port):
+        port.reset_input_buffer()
+        self.skip(len(self.buffer))
+
+    # returns (status, data) of the next frame, or None if no (complete) frame is received before the serial timeout.
+    def read_frame(self, port):
+        while True:
+            frame = self.next_frame()
+            if frame:
+                return frame
+            data = port.read(self.missing())
+            if not data:
+                return None
+            self.buffer += data
+
+    # the same, on the event loop.  port.read() is a coroutine, see aserial.AsyncPort
+    async def aread_frame(self, port):
+        while True:
+            frame = self.next_frame()
+            if frame:
+                return frame
+            data = await port.read(self.missing())
+            if not data:
+                return None
+            self.buffer += data
+
+    # number of bytes that are required to complete the next frame
+    def missing(self):
+        if len(self.buffer) < HEADER_LEN:
+            return HEADER_LEN - len(self.buffer)
+        return HEADER_LEN + self.buffer[4] + 1 - len(self.buffer)
+
+    def next_frame(self):
+        while True:
+            start = self.buffer.find(RESPONSE_HEADER)
+            if start < 0:
+                # keep a trailing CD, it can be the start of the next header
+                keep = 1 if self.buffer[-1:] == RESPONSE_HEADER[:1] else 0
+                self.skip(len(self.buffer) - keep)
+                return None
+            self.skip(start)
+            if len(self.buffer) < HEADER_LEN:
+                return None
+            length = self.buffer[4]
+            if length > MAX_DATA_LEN:
+                self.skip(1)
+                continue
+            end = HEADER_LEN + length + 1
+            if len(self.buffer) < end:
+                return None
+            with memoryview(self.buffer) as view: # no copies of the buffer, the view is released before the buffer is changed
+                valid = checksum(view[2:end - 1]) == view[end - 1]
+                if valid:
+                    status, data = view[3], view[HEADER_LEN:end - 1].tobytes()
+            if not valid:
+                self.skip(1)
+                continue
+            del self.buffer[:end]
+            return status, data
+
+    def skip(self, nbr_bytes):
+        if nbr_bytes > 0:
+            del self.buffer[:nbr_bytes]
+            self.garbage_ctr += nbr_bytes
+
+
+# A driver knows the commands and responses of a reader model.  poll() is the hot path: send the (precomputed) read
+# command and return the badge code (hex string) or None when no badge is presented.  apoll() is the same, on the event
+# loop (see aserial.AsyncPort).
+class ReaderDriver():
+    model = ""
+
+    def poll(self, port):
+        raise NotImplementedError
+
+    async def apoll(self, port):
+        raise NotImplementedError
+
+
+class Driver7941W(ReaderDriver):
+    model = "7941W"
+    READ_UID = command(0x10) # AB BA 00 10 00 10
+    STATUS_UID = 0x81
+    UID_LENGTHS = (4, 7, 10) # single, double and triple size uids
+
+    def __init__(self):
+        self.decoder = FrameDecoder()
+        self.last_frame = None # (status, data), for debugging
+
+    def poll(self, port):
+        self.decoder.discard(port)
+        port.write(self.READ_UID)
+        return self.code(self.decoder.read_frame(port))
+
+    async def apoll(self, port):
+        self.decoder.discard(port)
+        port.write(self.READ_UID)
+        return self.code(await self.decoder.aread_frame(port))
+
+    def code(self, frame):
+        self.last_frame = frame
+        if frame and frame[0] == self.STATUS_UID and len(frame[1]) in self.UID_LENGTHS:
+            return frame[1].hex()
+        return None
+
+
+DRIVERS = {d.model: d for d in (Driver7941W,)}
+
+
+def create_driver(model="7941W"):
+    return DRIVERS[model]()
@@ -2,30 +2,59 @@
 # RFID registrations are sent directly to the badge-registration-server
 
 import time
+import_start = time.perf_counter()
 import urllib.parse
+import asyncio
+from contextlib import asynccontextmanager
 
-from fastapi import FastAPI
+from fastapi import FastAPI, APIRouter, Request, Response
+from fastapi.responses import StreamingResponse
 from fastapi.middleware.cors import CORSMiddleware
-import threading, logging, glob
-import sys, os,  serial, re, requests, binascii, datetime
-import serial.tools.list_ports as port_list
+import threading, logging, queue, sqlite3, json, uuid, collections
+import sys, os, datetime
+from hotplug import find_readers, HotplugWatcher
+from aserial import open_port
+from protocol import create_driver
+from health import ReaderHealth
+from tracing import Clock, Trace, TraceLog
+from debounce import DebounceCache
+from feedback import Feedback
+from logqueue import setup_logging, Sampler
+from updates import UpdateIndex, etag_matches
+import journal
+import metrics
+import config
 from config import LOG_HANDLE, LOG_FILE, LOG_LEVEL, BR_URL, BR_KEY, RESOLUTION
-from logging.handlers import RotatingFileHandler
 
-#  enable logging
+# optional settings, not present in older config files
+UPLINK_WORKERS = getattr(config, "UPLINK_WORKERS", 4) # number of concurrent requests to the badge-registration-server
+UPLINK_QUEUE_LEN = getattr(config, "UPLINK_QUEUE_LEN", 1000)
+OUTBOX_FILE = getattr(config, "OUTBOX_FILE", "outbox.db") # registrations that are not sent yet, survives a restart
+OUTBOX_RETRY_MIN = getattr(config, "OUTBOX_RETRY_MIN", 2) # seconds, first retry.  Doubled after every failed retry
+OUTBOX_RETRY_MAX = getattr(config, "OUTBOX_RETRY_MAX", 300)
+BATCH_WINDOW = getattr(config, "BATCH_WINDOW", 0) # milliseconds, collect registrations and send them in one request.  0 is disabled
+BATCH_MAX = getattr(config, "BATCH_MAX", 50) # maximum number of registrations in one request
+POLL_INTERVAL = getattr(config, "POLL_INTERVAL", 0.02) # seconds, time between 2 polls of a reader
+DEBOUNCE_WINDOW = getattr(config, "DEBOUNCE_WINDOW", 2) # seconds (as websocket.py), same badge is not registered again within this window, on any reader
+DEBOUNCE_MAX = getattr(config, "DEBOUNCE_MAX", 10000) # maximum number of badges that are remembered
+READER_MODEL = getattr(config, "READER_MODEL", "7941W") # see protocol.DRIVERS
+LOG_FORMAT = getattr(config, "LOG_FORMAT", "text") # text or json (one json object per line)
+LOG_QUEUE_LEN = getattr(config, "LOG_QUEUE_LEN", 10000) # log records waiting to be written, dropped when full
+BADGE_CACHE_LEN = getattr(config, "BADGE_CACHE_LEN", 50000) # known badges, for immediate feedback.  0 is disabled
+BADGE_SYNC_INTERVAL = getattr(config, "BADGE_SYNC_INTERVAL", 60) # seconds, between 2 delta syncs of the known badges
+JOURNAL_DIR = getattr(config, "JOURNAL_DIR", "journal") # journal of the scans, see journal.py.  "" is disabled
+JOURNAL_SEGMENT_SIZE = getattr(config, "JOURNAL_SEGMENT_SIZE", 16 * 1024 * 1024) # bytes, about 700000 scans
+JOURNAL_SEGMENTS = getattr(config, "JOURNAL_SEGMENTS", 16) # the oldest segment is removed
+HEALTH_STALL_TIMEOUT = getattr(config, "HEALTH_STALL_TIMEOUT", 3) # seconds without an answer of a reader, then its port is closed and opened again
+HEALTH_PROBE_INTERVAL = getattr(config, "HEALTH_PROBE_INTERVAL", 5) # seconds, a reader that is not polled (not active, no location) is probed
+HEALTH_BACKOFF_MAX = getattr(config, "HEALTH_BACKOFF_MAX", 30) # seconds, maximum wait before a reader that keeps stalling is opened again
+TRACE_LEN = getattr(config, "TRACE_LEN", 1000) # number of recent scans with a latency trace, see /traces
+
+#  logging via a queue: the poll threads do not wait for the disk.  The log file is opened at startup, see lifespan
 top_log_handle = LOG_HANDLE
-log = logging.getLogger(top_log_handle)
-
 LOG_FILENAME = os.path.join(sys.path[0], f'log/{LOG_FILE}.txt')
-try:
-    log_level = getattr(logging, LOG_LEVEL)
-except:
-    log_level = getattr(logging, 'INFO')
-log.setLevel(log_level)
-log_handler = RotatingFileHandler(LOG_FILENAME, maxBytes=1024 * 1024, backupCount=20)
-log_formatter = logging.Formatter('%(asctime)s - %(levelname)s - %(name)s - %(message)s')
-log_handler.setFormatter(log_formatter)
-log.addHandler(log_handler)
+log = logging.getLogger(top_log_handle)
+log_handler = None # logqueue.NonBlockingQueueHandler
 
 # 0.1 initial version
 # 0.2: upgrade serial port handling
@@ -40,245 +69,788 @@ log.addHandler(log_handler)
 # 0.12: add resolution, second (default) or millisecond
 # 0.13: add comment
 # 0.14: add comment
-
-version = "0.14"
-
-#linux beep:
-# sudo apt install beep
+# 0.22: registrations are sent by a pool of uplink workers with keep-alive connections.  Polling does not wait for the network anymore.
+# 0.23: registrations are stored in a local outbox (sqlite) before they are sent.  When the badge-registration-server is not
+# reachable, they are resent later, with exponential backoff.
+# 0.24: optional batch mode, registrations are collected during a window and sent in one request.  The beep is given
+# when the registration is stored locally.
+# 0.25: multiple RFID readers.  Every reader has its own thread and can have its own location.
+# 0.26: attached/detached readers are detected with inotify (linux).  A new port is opened with increasing delays.
+# 0.27: read exactly one response frame instead of waiting for the serial timeout.  Poll every 20ms instead of 100ms.
+# 0.28: the reader protocol is moved to protocol.py, with a driver per reader model.  Support for 7 and 10 byte uids.
+# 0.29: added /metrics (prometheus)
+# 0.30: repeated scans are suppressed per badge during a time window (DEBOUNCE_WINDOW), shared by the readers.
+# 0.31: beeps are played by a feedback worker (feedback.py) instead of the beep utility, polling and sending do not wait for a beep.
+# 0.32: log records are written to the file by a separate thread (logqueue.py).  Optional json format.  Received frames are
+# logged at debug level, at most once per second.
+# 0.33: the settings are an immutable snapshot that is replaced by the setters.  A change is applied at the next poll.
+# 0.34: /update: the update files are indexed once (updates.py), ETag/If-None-Match, gzip, large responses are streamed.
+# 0.35: the readers and the hotplug detection run on the event loop of uvicorn (aserial.py), no poll threads anymore.
+# The uplink (network, sqlite) keeps its worker threads.
+# 0.36: feedback from a local cache of known badges (delta sync with the server), the answer of the server corrects it.
+# 0.37: every scan is appended to a journal (journal.py), with queries by time, location and badge: /journal/scans
+# 0.41: create_app(), importing the module does not start anything.  Startup and shutdown in the lifespan: the api is
+# served as soon as the uplink is ready, the journal, the audio and the reader discovery start in the background.  The
+# startup times are available at /startup.
+# 0.43: reader watchdog (health.py), a reader that does not answer anymore is closed and opened again.  /readers contains
+# the health of the readers.
+# 0.45: the timestamp of a scan is the time the response of the reader is received (tracing.py).  Every scan has a trace of
+# the duration of its stages, until the answer of the badge-registration-server.  The slowest recent scans: /traces
+
+version = "0.45"
+
+#linux beep (pc speaker):
+# sudo modprobe pcspkr
 # sudo usermod -aG input badgereader
 #linux ch340 serial:
 # sudo apt autoremove brltty
 # sudo usermod -aG dialout badgereader
 
-# uvicorn.exe rfidusb:app
+# uvicorn.exe rfidusb:app   or   uvicorn.exe --factory rfidusb:create_app
 # taskkill /F /IM uvicorn.exe
 
 # take into account the reader is attached to, detached from or switched to another USB port
 
-log.info("start")
+# Seconds since the start of the import of this module, when a step of the startup is done, see /startup
+class StartupTimes():
+    def __init__(self, start):
+        self.start = start # time.perf_counter()
+        self.times = {}
 
-app = FastAPI()
-origins = ["*",]
-app.add_middleware(
-    CORSMiddleware,
-    allow_origins=origins,
-    allow_credentials=True,
-    allow_methods=["*"],
-    allow_headers=["*"],
-    expose_headers=["*"])
+    def mark(self, step):
+        self.times[step] = round(time.perf_counter() - self.start, 4)
 
+    def stats(self):
+        return dict(self.times)
 
-os_linux = "linux" in sys.platform
 
-if not os_linux:
-    import winsound
+startup = StartupTimes(import_start)
+router = APIRouter()
 
-class Rfid7941W():
-    read_uid = bytearray(b'\xab\xba\x00\x10\x00\x10')
-    resp_len = 2405
 
-    def __init__(self):
-        self.__port = None
-        self.__location = None
-        self.__url = BR_URL
-        self.__api_key = BR_KEY
-        self.__active = False
-        self.__resolution = RESOLUTION
-        self.ctr = 0
-        self.prev_code = ""
+registry = metrics.Registry()
+serial_rtt = registry.histogram("rfid_serial_rtt_seconds", "Time to send a command to the reader and receive the response")
+poll_cycle = registry.histogram("rfid_poll_cycle_seconds", "Time to handle one poll of a reader")
+scan_to_uplink = registry.histogram("rfid_scan_to_uplink_seconds", "Time between a scan and the answer of the badge-registration-server")
+post_latency = registry.histogram("rfid_post_seconds", "Duration of a POST to the badge-registration-server")
+post_status = registry.labeled_counter("rfid_post_status_total", "Answers of the badge-registration-server", "code")
+scans = registry.counter("rfid_scans_total", "Registrations")
+duplicates = registry.counter("rfid_duplicates_total", "Scans that are suppressed because the same badge was scanned just before")
+reconnects = registry.counter("rfid_port_reconnects_total", "Number of times a reader port is opened")
+recoveries = registry.counter("rfid_reader_recoveries_total", "Number of times a stalled reader is closed and opened again")
+dropped = registry.counter("rfid_dropped_events_total", "Registrations that are dropped because the uplink queue is full")
 
-    @property
-    def system_port(self):
-        return self.__port
+# recently scanned badges, shared by the readers
+debounce = DebounceCache(DEBOUNCE_WINDOW, DEBOUNCE_MAX)
+registry.gauge("rfid_debounce_badges", "Number of recently scanned badges that are remembered", lambda: len(debounce))
 
-    @system_port.setter
-    def system_port(self, value):
-        self.__port = value
+frame_sampler = Sampler(1) # log at most one received frame per second
+clock = Clock()
+traces = TraceLog(TRACE_LEN) # key (badge_code, timestamp), as the journal
+registry.gauge("rfid_log_dropped_total", "Log records dropped because the log queue is full", lambda: log_handler.dropped_ctr if log_handler else 0, type="counter")
 
-    @property
-    def location(self):
-        return self.__location
 
-    @location.setter
-    def location(self, value):
-        self.__location = value
+feedback = Feedback()
 
-    @property
-    def url(self):
-        return self.__url
 
-    @url.setter
-    def url(self, value):
-        self.__url = value
+# does not wait, the beep is played by the feedback worker
+def beep(ok, scanned=None):
+    feedback.play("ok" if ok else "error", scanned)
 
-    @property
-    def api_key(self):
-        return self.__api_key
 
-    @api_key.setter
-    def api_key(self, value):
-        self.__api_key = value
+scan_journal = None # journal.Journal, opened at startup
 
-    @property
-    def active(self):
-        return self.__active
 
-    @active.setter
-    def active(self, value):
-        self.__active = value
+def open_journal():
+    global scan_journal
+    if JOURNAL_DIR:
+        try:
+            scan_journal = journal.Journal(JOURNAL_DIR, JOURNAL_SEGMENT_SIZE, JOURNAL_SEGMENTS)
+        except Exception as e:
+            log.error(f"Could not open the journal {JOURNAL_DIR}, {e}")
+
+
+# the upload status of a registration in the journal.  status: True, False (the server answered) or journal.FAILED
+def journal_status(registration, status):
+    if scan_journal:
+        if status is not journal.FAILED:
+            status = journal.OK if status else journal.REJECTED
+        scan_journal.set_status((registration["badge_code"], registration["timestamp"]), status)
+
+
+# Every registration is stored in the outbox before it is sent to the badge-registration-server, and removed when the
+# server has accepted it.  Every registration has a unique key (x-idempotency-key) so that the server can detect a resend.
+# Thread safe, a single connection is shared behind a lock.
+class Outbox():
+    def __init__(self, filename=OUTBOX_FILE):
+        self.lock = threading.Lock()
+        self.db = sqlite3.connect(os.path.join(sys.path[0], filename), check_same_thread=False, isolation_level=None)
+        self.db.execute("PRAGMA journal_mode=WAL")
+        self.db.execute("PRAGMA synchronous=FULL")
+        self.db.execute("CREATE TABLE IF NOT EXISTS outbox (id INTEGER PRIMARY KEY, key TEXT, url TEXT, api_key TEXT, registration TEXT, created REAL, attempts INTEGER, next_attempt REAL)")
+
+    # store a batch of (url, api_key, registration, scanned), in a single transaction, i.e. a single fsync.
+    # The registrations are not retried before delay seconds, to give the uplink workers the time to send them.
+    # Returns the rows (id, key, url, api_key, registration, scanned)
+    def add(self, items, delay=30):
+        now = time.time()
+        rows = []
+        with self.lock:
+            self.db.execute("BEGIN")
+            try:
+                for url, api_key, registration, scanned in items:
+                    key = uuid.uuid4().hex
+                    cursor = self.db.execute("INSERT INTO outbox (key, url, api_key, registration, created, attempts, next_attempt) VALUES (?, ?, ?, ?, ?, 0, ?)",
+                                             (key, url, api_key, json.dumps(registration), now, now + delay))
+                    rows.append((cursor.lastrowid, key, url, api_key, registration, scanned))
+                self.db.execute("COMMIT")
+            except Exception:
+                self.db.execute("ROLLBACK") # else the transaction stays open and every next add fails
+                raise
+        return rows
+
+    # the ids that are still in the outbox, i.e. not sent yet
+    def present(self, ids):
+        with self.lock:
+            return {row[0] for row in self.db.execute(f"SELECT id FROM outbox WHERE id IN ({','.join('?' * len(ids))})", ids)}
+
+    def remove(self, ids):
+        with self.lock:
+            self.db.executemany("DELETE FROM outbox WHERE id = ?", [(id,) for id in ids])
+
+    def retry_later(self, id):
+        with self.lock:
+            self.db.execute("UPDATE outbox SET attempts = attempts + 1, next_attempt = ? + MIN(?, ? * (1 << MIN(attempts, 20))) WHERE id = ?",
+                            (time.time(), OUTBOX_RETRY_MAX, OUTBOX_RETRY_MIN, id))
+
+    # the registrations that need to be resent, oldest first
+    def due(self, limit=100):
+        with self.lock:
+            rows = self.db.execute("SELECT id, key, url, api_key, registration FROM outbox WHERE next_attempt <= ? ORDER BY id LIMIT ?", (time.time(), limit)).fetchall()
+        return [(id, key, url, api_key, json.loads(registration), None) for id, key, url, api_key, registration in rows]
+
+    def next_attempt(self):
+        with self.lock:
+            return self.db.execute("SELECT MIN(next_attempt) FROM outbox").fetchone()[0]
+
+    def stats(self):
+        with self.lock:
+            depth, oldest = self.db.execute("SELECT COUNT(*), MIN(created) FROM outbox").fetchone()
+        return {"depth": depth, "oldest_age": round(time.time() - oldest, 3) if oldest else 0}
+
+
+# Sends the registrations to the badge-registration-server, on separate threads so that the serial polling never waits
+# for the network.
+# The store thread takes the new registrations in batches and stores them in the outbox.  Then they are sent by the
+# uplink workers, every worker has its own requests.Session, i.e. the connection is kept alive between registrations.
+# If a registration could not be sent, it remains in the outbox and is resent by the replay thread.
+# requests is imported by the threads, not at startup.
+# In batch mode (batch_window > 0), the registrations are collected during batch_window milliseconds (or until there are
+# BATCH_MAX) and sent in one request.  If the server does not support batches, they are sent one by one.
+class Uplink():
+    def __init__(self, nbr_workers=UPLINK_WORKERS, maxlen=UPLINK_QUEUE_LEN):
+        self.queue = queue.Queue(maxsize=maxlen)
+        self.send_queue = queue.Queue()
+        self.outbox = Outbox()
+        self.nbr_workers = nbr_workers
+        self.dropped_ctr = 0
+        self.batch_window = BATCH_WINDOW
+        self.no_batch_urls = set() # badge-registration-servers that do not support batches
+        self.in_flight = set() # outbox ids that wait for or are being sent by a worker, or are resent by the replay thread
+        self.in_flight_lock = threading.Lock()
+        self.stopping = threading.Event()
+        self.threads = []
+
+    def start(self):
+        self.threads = [threading.Thread(target=self.store, daemon=True, name="uplink-store"),
+                        threading.Thread(target=self.replay, daemon=True, name="uplink-replay")]
+        self.threads += [threading.Thread(target=self.worker, daemon=True, name=f"uplink-{i}") for i in range(self.nbr_workers)]
+        for thread in self.threads:
+            thread.start()
+
+    # The registrations in the queue are stored in the outbox, the batch that is collected is not sent: these are resent
+    # from the outbox at the next start.  A worker finishes the request it is sending (or times out).
+    def stop(self, timeout=2):
+        self.stopping.set()
+        self.queue.put(None)
+        for _ in range(self.nbr_workers):
+            self.send_queue.put(None)
+        end = time.monotonic() + timeout
+        for thread in self.threads:
+            thread.join(max(0, end - time.monotonic()))
+
+    # called from the polling thread, never blocks.  scanned is the time.perf_counter() of the scan
+    def send(self, url, api_key, registration, scanned=None):
+        try:
+            self.queue.put_nowait((url, api_key, registration, scanned))
+        except queue.Full:
+            self.dropped_ctr += 1
+            dropped.inc()
+            journal_status(registration, journal.FAILED)
+            log.error(f"Uplink queue full, dropped {registration['badge_code']} at {registration['timestamp']}")
+
+    # store the new registrations in the outbox and pass them to the workers, one by one or as a batch.
+    # send_queue contains (rows, batched)
+    def store(self):
+        batch = []
+        deadline = None
+        while True:
+            try:
+                items = [self.queue.get(timeout=None if deadline is None else max(0, deadline - time.time()))]
+            except queue.Empty:
+                items = []
+            while 0 < len(items) < 100:
+                try:
+                    items.append(self.queue.get_nowait())
+                except queue.Empty:
+                    break
+            stop = None in items
+            items = [item for item in items if item is not None]
+            rows = []
+            if items:
+                try:
+                    rows = self.outbox.add(items)
+                except Exception as e:
+                    log.error(f"Could not store in outbox, {e}")
+                    rows = [(None, uuid.uuid4().hex, url, api_key, registration, scanned) for url, api_key, registration, scanned in items]
+                self.hold(rows)
+                for row in rows:
+                    traces.mark((row[4]["badge_code"], row[4]["timestamp"]), "store")
+            if self.batch_window > 0:
+                if rows:
+                    if [row for row in rows if not badge_cache.is_predicted(row[4]["badge_code"])]:
+                        beep(True, rows[-1][5]) # stored locally, the registration is accepted
+                    batch += rows
+                    if deadline is None:
+                        deadline = time.time() + self.batch_window / 1000
+                if batch and (len(batch) >= BATCH_MAX or time.time() >= deadline):
+                    while batch:
+                        self.send_queue.put((batch[:BATCH_MAX], True))
+                        batch = batch[BATCH_MAX:]
+                    deadline = None
+            else:
+                for row in batch + rows: # left over when batch mode is switched off
+                    self.send_queue.put(([row], False))
+                batch = []
+                deadline = None
+            if stop:
+                return
+
+    # returns the status of the badge-registration-server, or None if the registration could not be sent.
+    # The caller removes the registration from the outbox when it is sent.
+    def post(self, session, id, key, url, api_key, registration, scanned=None):
+        code, timestamp = registration["badge_code"], registration["timestamp"]
+        traces.mark((code, timestamp), "queue")
+        try:
+            ___start = time.perf_counter()
+            ret = session.post(f"{url}/api/registration/add", headers={'x-api-key': api_key, 'x-idempotency-key': key}, json=registration, timeout=10)
+            post_latency.observe(time.perf_counter() - ___start)
+            post_status.labels(ret.status_code).inc()
+        except Exception as e:
+            log.error(f"requests.post() threw exception: {e}")
+            post_status.labels("error").inc()
+            ret = None
+        traces.mark((code, timestamp), "uplink", last=True)
+        if ret is not None and ret.status_code == 200:
+            if scanned is not None:
+                scan_to_uplink.observe(time.perf_counter() - scanned)
+            return ret.json()["status"]
+        if ret is not None:
+            log.error(f"requests.post() returned {ret.status_code}, {code} at {timestamp}")
+        if id is not None:
+            self.outbox.retry_later(id)
+        return None
+
+    # returns True if the batch is sent, False if it could not be sent and None if the server does not support batches.
+    def post_batch(self, session, rows):
+        url, api_key = rows[0][2], rows[0][3]
+        registrations = [{**registration, "key": key} for id, key, url, api_key, registration, scanned in rows]
+        trace_keys = [(r["badge_code"], r["timestamp"]) for r in registrations]
+        for trace_key in trace_keys:
+            traces.mark(trace_key, "queue")
+        try:
+            ___start = time.perf_counter()
+            ret = session.post(f"{url}/api/registration/batch", headers={'x-api-key': api_key}, json={"registrations": registrations}, timeout=10)
+            post_latency.observe(time.perf_counter() - ___start)
+            post_status.labels(ret.status_code).inc()
+        except Exception as e:
+            log.error(f"requests.post() threw exception: {e}")
+            post_status.labels("error").inc()
+            return False
+        if ret.status_code in (404, 405):
+            log.info(f"{url} does not support batches")
+            self.no_batch_urls.add(url)
+            return None
+        if ret.status_code != 200:
+            log.error(f"requests.post() returned {ret.status_code}, batch of {len(rows)}")
+            return False
+        try:
+            answer = ret.json()
+        except ValueError:
+            answer = {}
+        statuses = answer.get("data") if isinstance(answer, dict) and answer.get("status") else None
+        if not isinstance(statuses, list) or len(statuses) != len(rows):
+            log.error(f"Batch of {len(rows)} not accepted, {answer.get('data') if isinstance(answer, dict) else answer}")
+            return False
+        for trace_key in trace_keys:
+            traces.mark(trace_key, "uplink", last=True)
+        now = time.perf_counter()
+        for row in rows:
+            if row[5] is not None:
+                scan_to_uplink.observe(now - row[5])
+        for row, status in zip(rows, statuses):
+            badge_cache.reconcile(row[4]["badge_code"], status) # no beep, a batch is acknowledged locally
+            journal_status(row[4], status)
+            if not status:
+                log.error(f"FOUT, {row[4]['badge_code']} at {row[4]['timestamp']}")
+        return True
+
+    # A row is sent by one thread at a time: the new rows are in flight from the moment they are stored until a worker
+    # sent them (or retries them later), also when they wait in send_queue longer than the outbox delay.  The replay
+    # thread claims the due rows that are not in flight and still in the outbox.  The rows are released when they are
+    # sent or retried later.
+    def hold(self, rows):
+        with self.in_flight_lock:
+            self.in_flight |= {row[0] for row in rows if row[0] is not None}
+
+    def claim(self, rows):
+        ids = [row[0] for row in rows]
+        with self.in_flight_lock:
+            claimed = self.outbox.present(ids) - self.in_flight if ids else set()
+            self.in_flight |= claimed
+        return [row for row in rows if row[0] in claimed]
+
+    def release(self, rows):
+        with self.in_flight_lock:
+            self.in_flight -= {row[0] for row in rows}
+
+    def worker(self):
+        import requests
+        session = requests.Session()
+        while True:
+            item = self.send_queue.get()
+            if item is None:
+                return
+            rows, batched = item
+            held = rows # rows is changed below
+            try:
+                if batched:
+                    # a batch is sent per server and key, these can be changed during the batch window
+                    groups = {}
+                    for row in rows:
+                        groups.setdefault((row[2], row[3]), []).append(row)
+                    rows = []
+                    for (url, api_key), group in groups.items():
+                        sent = self.post_batch(session, group) if url not in self.no_batch_urls else None
+                        if sent is None:
+                            rows += group
+                        elif sent:
+                            self.outbox.remove([row[0] for row in group if row[0] is not None])
+                        else:
+                            for row in group:
+                                if row[0] is not None:
+                                    self.outbox.retry_later(row[0])
+                for id, key, url, api_key, registration, scanned in rows:
+                    status = self.post(session, id, key, url, api_key, registration, scanned)
+                    if status is not None:
+                        if id is not None:
+                            self.outbox.remove([id])
+                        if status:
+                            log.info("OK, %s at %s", registration['badge_code'], registration['timestamp'])
+                        else:
+                            log.error("FOUT, %s at %s", registration['badge_code'], registration['timestamp'])
+                        journal_status(registration, status)
+                        if badge_cache.reconcile(registration['badge_code'], status) and not batched:
+                            beep(status, scanned)
+            except Exception as e:
+                log.error(f"Uplink worker, {e}")
+            finally:
+                self.release(held)
+
+    # resend the registrations from the outbox, oldest first.  Stop at the first failure, the server is probably not
+    # reachable, and wait before trying again (exponential backoff).
+    def replay(self):
+        import requests
+        session = requests.Session()
+        backoff = OUTBOX_RETRY_MIN
+        while not self.stopping.is_set():
+            try:
+                next_attempt = self.outbox.next_attempt()
+                if next_attempt is None or next_attempt > time.time():
+                    self.stopping.wait(1)
+                    continue
+                rows = self.claim(self.outbox.due())
+                if not rows: # the due registrations are being sent by the workers
+                    self.stopping.wait(1)
+                    continue
+                log.info(f"Outbox, resend {len(rows)} registrations")
+                sent = []
+                try:
+                    for id, key, url, api_key, registration, scanned in rows:
+                        status = self.post(session, id, key, url, api_key, registration)
+                        if status is None:
+                            break
+                        badge_cache.reconcile(registration['badge_code'], status) # too late for feedback
+                        journal_status(registration, status)
+                        sent.append(id)
+                    self.outbox.remove(sent)
+                finally:
+                    self.release(rows)
+                if len(sent) < len(rows):
+                    self.stopping.wait(backoff)
+                    backoff = min(backoff * 2, OUTBOX_RETRY_MAX)
+                else:
+                    backoff = OUTBOX_RETRY_MIN
+            except Exception as e:
+                log.error(f"Outbox replay, {e}")
+                self.stopping.wait(1)
+
+    def stats(self):
+        return {"workers": self.nbr_workers, "pending": self.queue.qsize() + self.send_queue.qsize(), "dropped": self.dropped_ctr}
+
+
+# The known badges and their status (True is valid), to give feedback immediately when a badge is scanned instead of
+# after the answer of the badge-registration-server.  The registration is sent as before, the answer of the server is
+# authoritative: when it differs from the feedback, the feedback is corrected (beep again) and the cache is updated.
+# The cache is filled at startup and kept up to date with delta syncs, and learns from every answer of the server:
+# GET <url>/api/badge/sync?since=<sync>, with x-api-key, answer
+# {"status": true, "data": [{"badge_code": "...", "valid": true}, ...], "sync": "<since of the next delta>", "full": true}
+# full is true when data contains all the badges (first sync or the server cannot give a delta).  A server without
+# /api/badge/sync (404, 405) is not synced, the cache only learns from the answers.
+# Bounded, the least recently used badge is removed.  Lookups are O(1).
+class BadgeCache():
+    def __init__(self, maxlen=BADGE_CACHE_LEN, sync_interval=BADGE_SYNC_INTERVAL):
+        self.maxlen = maxlen
+        self.sync_interval = sync_interval
+        self.badges = collections.OrderedDict() # badge_code: valid
+        self.predicted = collections.OrderedDict() # badge_code: feedback given from the cache, until the server answers
+        self.lock = threading.Lock()
+        self.url = None # of the synced server
+        self.since = None
+        self.last_sync = None # time.time()
+        self.no_sync_urls = set()
+        self.hit_ctr = 0
+        self.miss_ctr = 0
+        self.mismatch_ctr = 0
+        self.stopping = threading.Event()
+
+    def start(self, get_settings):
+        if self.maxlen > 0:
+            threading.Thread(target=self.run, args=(get_settings,), daemon=True, name="badge-sync").start()
+
+    def stop(self):
+        self.stopping.set()
+
+    # returns the status of a scanned badge (True is valid), or None when it is not known
+    def predict(self, code):
+        if self.maxlen <= 0:
+            return None
+        with self.lock:
+            valid = self.badges.get(code)
+            if valid is None:
+                self.miss_ctr += 1
+                return None
+            self.hit_ctr += 1
+            self.badges.move_to_end(code)
+            self.predicted[code] = valid
+            while len(self.predicted) > self.maxlen:
+                self.predicted.popitem(last=False)
+            return valid
+
+    # True if feedback was given from the cache for this badge, and the server did not answer yet
+    def is_predicted(self, code):
+        return code in self.predicted
+
+    # the answer of the server.  Returns True when feedback is required: no feedback is given yet, or the feedback was
+    # wrong.
+    def reconcile(self, code, valid):
+        with self.lock:
+            predicted = self.predicted.pop(code, None)
+            self.__set(code, valid)
+            if predicted is not None and predicted != valid:
+                self.mismatch_ctr += 1
+        if predicted is None:
+            return True
+        if predicted != valid:
+            log.error(f"Badge cache, {code} is {'valid' if valid else 'not valid'}, wrong feedback is corrected")
+            return True
+        return False
+
+    def __set(self, code, valid):
+        if self.maxlen <= 0:
+            return
+        self.badges[code] = valid
+        self.badges.move_to_end(code)
+        while len(self.badges) > self.maxlen:
+            self.badges.popitem(last=False)
+
+    def run(self, get_settings):
+        import requests # not at startup
+        session = requests.Session()
+        while not self.stopping.is_set():
+            settings = get_settings()
+            if settings.url and settings.url not in self.no_sync_urls:
+                try:
+                    self.sync(session, settings.url, settings.api_key)
+                except Exception as e:
+                    log.error(f"Badge cache sync, {e}")
+            self.stopping.wait(self.sync_interval if self.last_sync else 2)
+
+    def sync(self, session, url, api_key):
+        if url != self.url: # another server, start over
+            self.url, self.since, self.last_sync = url, None, None
+            with self.lock:
+                self.badges.clear()
+        params = {"since": self.since} if self.since else {}
+        ret = session.get(f"{url}/api/badge/sync", headers={'x-api-key': api_key}, params=params, timeout=10)
+        if ret.status_code in (404, 405):
+            log.info(f"{url} does not support badge sync")
+            self.no_sync_urls.add(url)
+            return
+        if ret.status_code != 200:
+            log.error(f"Badge cache sync returned {ret.status_code}")
+            return
+        answer = ret.json()
+        if not answer.get("status"):
+            log.error(f"Badge cache sync, {answer.get('data')}")
+            return
+        with self.lock:
+            if answer.get("full"):
+                self.badges.clear()
+            for badge in answer["data"]:
+                self.__set(badge["badge_code"], badge["valid"])
+        self.since = answer.get("sync")
+        self.last_sync = time.time()
+        log.info(f"Badge cache sync, {len(answer['data'])} badges, {len(self.badges)} known")
+
+    def stats(self):
+        lookups = self.hit_ctr + self.miss_ctr
+        return {"size": len(self.badges), "maxlen": self.maxlen, "hits": self.hit_ctr, "misses": self.miss_ctr,
+                "hit_rate": round(self.hit_ctr / lookups, 3) if lookups else None, "mismatches": self.mismatch_ctr,
+                "last_sync": self.last_sync, "url": self.url, "sync_supported": self.url not in self.no_sync_urls}
+
+
+badge_cache = BadgeCache()
+
+
+# The settings of the readers.  A snapshot is never changed: a setter creates a new snapshot and replaces the reference,
+# which is atomic.  The poll threads take the current snapshot every cycle, i.e. a change is applied at the next poll,
+# and nobody waits for a lock.  locations is {reader_id: location}, it is copied, not changed.
+Settings = collections.namedtuple("Settings", "location locations url api_key active resolution")
+
+
+class Rfid7941W():
+    def __init__(self, uplink, reader_id, port_name, get_settings):
+        self.__uplink = uplink
+        self.reader_id = reader_id
+        self.port_name = port_name
+        self.__get_settings = get_settings # returns the current Settings
+        self.task = None
+        self.driver = create_driver(READER_MODEL)
+        self.__port = None # aserial.AsyncPort
+        self.health = ReaderHealth(HEALTH_STALL_TIMEOUT, HEALTH_PROBE_INTERVAL, HEALTH_BACKOFF_MAX)
 
     @property
-    def resolution(self):
-        return self.__resolution
+    def system_port(self):
+        return self.__port
 
-    @resolution.setter
-    def resolution(self, value):
-        self.__resolution = value
+    @system_port.setter
+    def system_port(self, value):
+        self.__port = value
 
-    def kick(self): # about 100ms
-        if self.__port and self.__location and self.__active:
+    @property
+    def location(self):
+        settings = self.__get_settings()
+        return settings.locations.get(self.reader_id, settings.location)
+
+    async def kick(self, settings, location): # a few ms, 100ms when the reader does not respond
+        if self.__port:
             try:
-                self.__port.write(self.read_uid) # command to get the serial number
-                rcv_raw = self.__port.read(self.resp_len)
-                if rcv_raw:
-                    rcv = binascii.hexlify(rcv_raw).decode("UTF-8")
-                    if rcv[6:8] == "81":  # valid uid received
-                        code = rcv[10:18]
-                        if code != self.prev_code or self.ctr > 5: # wait at least 5 seconds before the same badge can be scanned or continue directly when a different badge is scanned.
-                            log.info(self.__resolution)
-                            if self.__resolution == "second":
-                                timestamp = datetime.datetime.now().isoformat()[:19]
-                            else:
-                                timestamp = datetime.datetime.now().isoformat()[:23]
-                            log.info(timestamp)
-                            try:
-                                ___start = datetime.datetime.now()
-                                ret = requests.post(f"{self.__url}/api/registration/add", headers={'x-api-key': self.__api_key}, json={"location_key": self.__location, "badge_code": code, "timestamp": timestamp})
-                                # wait at least 1 second
-                                delta = datetime.datetime.now() - ___start
-                                if delta.total_seconds() < 1:
-                                    time.sleep(1)
-                                delta = datetime.datetime.now() - ___start
-                                log.info(f"request: {delta}")
-                            except Exception as e:
-                                log.error(f"requests.post() threw exception: {e}")
-                                return
-                            if ret.status_code == 200:
-                                res = ret.json()
-                                if res["status"]:
-                                    log.info(f"OK, {code} at {timestamp}")
-                                    if os_linux:
-                                        os.system("/usr/bin/beep -f 1500 -l 200")
-                                    else:
-                                        winsound.Beep(1500, 200)
-                                else:
-                                    log.error(f"FOUT, {code} at {timestamp}")
-                                    if os_linux:
-                                        os.system("/usr/bin/beep -f 1500 -l 800")
-                                    else:
-                                        winsound.Beep(1500, 800)
-                            self.ctr = 0
-                        self.prev_code = code
-                        self.ctr += 1
+                poll_start = time.perf_counter()
+                code = await self.__port.poll(self.driver) # get the serial number of the badge, if present
+                decoded = time.perf_counter()
+                captured = self.__port.received or decoded # capture time of the response
+                serial_rtt.observe(captured - poll_start)
+                self.record(self.driver.last_frame is not None)
+                if log.isEnabledFor(logging.DEBUG) and frame_sampler.allow():
+                    log.debug("system-port read %s, reader %s", self.driver.last_frame, self.reader_id)
+                if code:
+                    if debounce.accept(code): # the same badge is not registered again within DEBOUNCE_WINDOW seconds
+                        trace = Trace(self.reader_id, code, poll_start, captured, decoded)
+                        wall = clock.wall(captured)
+                        timestamp = datetime.datetime.fromtimestamp(wall).isoformat()[:19 if settings.resolution == "second" else 23]
+                        trace.timestamp = timestamp
+                        trace.mark("debounce")
+                        traces.add(trace, key=(code, timestamp))
+                        log.info("%s, reader %s", timestamp, self.reader_id)
+                        predicted = badge_cache.predict(code)
+                        if predicted is not None: # immediate feedback, the server answers later
+                            beep(predicted, captured)
+                        if scan_journal:
+                            scan_journal.append(code, location, self.reader_id, key=(code, timestamp), timestamp=wall)
+                        self.__uplink.send(settings.url, settings.api_key, {"location_key": location, "badge_code": code, "timestamp": timestamp}, captured)
+                        scans.inc()
+                    else:
+                        duplicates.inc()
             except Exception as e:
-                log.info(f"Port detattached, {e}")
+                if not self.health.streak: # once, not at every poll
+                    log.info(f"Port detattached, {e}")
+                self.record(False, e)
         # time.sleep(0.1)
 
+    # the reader is not polled, check that it still answers
+    async def probe(self):
+        try:
+            await self.__port.poll(self.driver)
+            self.record(self.driver.last_frame is not None)
+        except Exception as e:
+            self.record(False, e)
+
+    def record(self, answered, error=None):
+        if self.health.record(answered, error):
+            log.info(f"Reader {self.reader_id} is {self.health.state}")
+
+    async def open_port(self):
+        self.__port = await open_port(self.port_name)
+        if not self.__port:
+            log.error(f"Tried to open port {self.port_name} for 10 seconds, did not work")
+            return False
+        log.info(f"Set Serial port, id {self.port_name}, reader {self.reader_id}")
+        reconnects.inc()
+        return True
+
+    # close the port and open it again, with a new driver.  Returns False when the port could not be opened
+    async def recover(self):
+        log.error(f"Reader {self.reader_id} does not answer for {HEALTH_STALL_TIMEOUT} seconds, reopen the port")
+        self.health.recovering()
+        recoveries.inc()
+        self.__port.close()
+        self.__port = None
+        await asyncio.sleep(self.health.backoff())
+        self.driver = create_driver(READER_MODEL)
+        if not await self.open_port():
+            return False
+        self.health.reopened()
+        return True
+
+    # on the event loop
+    def start(self):
+        self.task = asyncio.create_task(self.run(), name=f"reader-{self.reader_id}")
+
+    def stop(self):
+        self.task.cancel()
+
+    # the poll loop of this reader, stopped by cancelling the task.  When the port cannot be opened (again), the task
+    # ends and the reader manager starts a new one.
+    async def run(self):
+        if not await self.open_port():
+            return
+        try:
+            while True:
+                if self.health.stalled and not await self.recover():
+                    return
+                settings = self.__get_settings()
+                location = settings.locations.get(self.reader_id, settings.location)
+                if location and settings.active:
+                    cycle_start = time.monotonic()
+                    await self.kick(settings, location) # every loop, check if a badge is presented to the reader
+                    cycle_delta = time.monotonic() - cycle_start
+                    poll_cycle.observe(cycle_delta)
+                    await asyncio.sleep(max(0, POLL_INTERVAL - cycle_delta))
+                else:
+                    if self.health.probe_due():
+                        await self.probe()
+                    await asyncio.sleep(0.1)
+        finally:
+            if self.__port:
+                self.__port.close()
+            self.__port = None
+            log.info(f"Disable Serial port, id {self.port_name}, reader {self.reader_id}")
+
 
 class BadgeServer():
 
     def init(self):
-        self.__port_name = "" # e.g. /dev/ttyUSB0.  Normally, the correct port is returned (with the RFID reader attached)
-        self.__location = ""
-        self.__api_key = ""
-        self.__url = ""
-        self.__active = False
-        self.__resolution = RESOLUTION
-        self.lock = threading.Lock()
-        self.rfid = Rfid7941W()
-        t = threading.Thread(target=self.run)
-        t.start()
-
-    # run is executed on a separate thread from uvicorn, a lock is required to pass info between them.
-    def run(self):
-        current_port_name = None
-        system_port = None
-        usbport_ctr = 0
+        # location is the default location, for the readers without a location of their own
+        self.settings = Settings(location="", locations={}, url=BR_URL, api_key=BR_KEY, active=False, resolution=RESOLUTION)
+        self.lock = threading.RLock() # only between the setters, the readers do not use it
+        self.uplink = Uplink()
+        self.uplink.start()
+        badge_cache.start(lambda: self.settings)
+        self.readers = {} # reader_id: Rfid7941W
+
+    # run is executed on the event loop of uvicorn, see lifespan.
+    # When a device node appears or disappears (or every 2 seconds), check which readers are attached, start a poll task
+    # for every new reader and stop the task of a detached reader.  The readers get the settings from self.settings.
+    async def run(self):
+        loop = asyncio.get_running_loop()
         log_port_disabled = True
-        while True:
-            self.rfid.kick() # every loop, check if a badge is presented to the reader
-            usbport_ctr += 1
-            if usbport_ctr >= 20: # every 20 loops, check the USB port and update settings (location, url, ...)
-                self.lock.acquire()
-                usbport_ctr = 0
-                # time.sleep(1)
-                if os_linux:
-                    port_names = [p.name for p in port_list.comports() if "usb" in p.name.lower()]
-                    port_name = port_names[0] if len(port_names) > 0 else None
-                    self.__port_name = "/dev/" + port_name if port_name else ""
-                else:
-                    port_names = [p.description for p in list(port_list.comports()) if "ch340" in p.description.lower()]
-                    port_name = port_names[0] if len(port_names) > 0 else None
-                    if port_name:
-                        port_match = re.search(r"\((.*)\)", port_name)
-                        if port_match:
-                            if not self.__port_name:
-                                time.sleep(1)
-                            self.__port_name = port_match[1]
-                    else:
-                        self.__port_name = ""
-                if self.__port_name:
-                    if self.__port_name != current_port_name: # if the reader is switched to another port
-                        # Although the port is present as /dev/ttyUSBxx, it is not accessible yet.  Try a few times with a delay in between
-                        try_to_open_port = 10
-                        while try_to_open_port > 0:
-                            try:
-                                system_port = serial.Serial(self.__port_name, baudrate=115200, bytesize=serial.EIGHTBITS, parity=serial.PARITY_NONE, stopbits=serial.STOPBITS_ONE, timeout=0.1)
-                                log.info(f"Set Serial port, id {self.__port_name}")
-                                try_to_open_port = 0
-                            except Exception as e:
-                                time.sleep(1)
-                                try_to_open_port -= 1
-                                if try_to_open_port <= 0:
-                                    log.error(f"Tried to open port {self.__port_name} 10 times, did not work")
-                        current_port_name = self.__port_name
-                        log_port_disabled = True
-                else: # reader is detached
-                    if system_port:
-                        system_port.close()
-                    system_port = current_port_name = None
-                    if log_port_disabled:
-                        log.info(f"Disable Serial port")
+        watcher = HotplugWatcher()
+        log.info(f"Reader hotplug detection: {watcher.mode} {watcher.error or ''}")
+        try:
+            while True:
+                try:
+                    ports = await loop.run_in_executor(None, find_readers) # lists /sys, blocking
+                    for reader_id, port_name in ports.items():
+                        rfid = self.readers.get(reader_id)
+                        if rfid and (rfid.port_name != port_name or rfid.task.done()):
+                            rfid.stop()
+                            rfid = None
+                        if not rfid:
+                            rfid = Rfid7941W(self.uplink, reader_id, port_name, lambda: self.settings)
+                            self.readers[reader_id] = rfid
+                            rfid.start()
+                            log_port_disabled = True
+                    for reader_id in [r for r in self.readers if r not in ports]: # reader is detached
+                        self.readers.pop(reader_id).stop()
+                    if not self.readers and log_port_disabled:
+                        log.info(f"No readers attached")
                         log_port_disabled = False
-                    time.sleep(2)
-                self.rfid.system_port = system_port
-                self.rfid.location = self.__location
-                self.rfid.url = self.__url
-                self.rfid.api_key = self.__api_key
-                self.rfid.active = self.__active
-                self.rfid.resolution = self.__resolution
-                # log.info(f", {self.rfid.location}, {self.rfid.url}, {self.rfid.api_key}, {self.rfid.active}, {self.rfid.system_port} ")
-                self.lock.release()
+                except Exception as e:
+                    log.error(f"Reader manager, {e}")
+                if "readers" not in startup.times:
+                    startup.mark("readers")
+                await watcher.wait_async(2)
+        finally:
+            for rfid in self.readers.values():
+                rfid.stop()
+            watcher.close()
+
+    # the threads of the uplink and the badge cache, the readers are stopped by cancelling run
+    def stop(self):
+        self.uplink.stop()
+        badge_cache.stop()
 
+    @property
+    def readers_info(self):
+        return [{"reader": r.reader_id, "port": r.port_name, "location": r.location, "connected": r.system_port is not None, **r.health.stats()}
+                for r in list(self.readers.values())]
 
     @property
     def port(self):
-        self.lock.acquire()
-        port_id = self.__port_name
-        self.lock.release()
-        return port_id
+        readers = list(self.readers.values())
+        return readers[0].port_name if readers else ""
 
     @property
     def location(self):
         return "NA"
 
 
+    # replace the settings snapshot, the lock prevents that 2 concurrent setters lose a change
+    def update(self, **changes):
+        self.lock.acquire()
+        self.settings = self.settings._replace(**changes)
+        self.lock.release()
+
     @location.setter
     def location(self, value):
-        self.lock.acquire()
         log.info(f"Set location, {value}")
-        self.__location = value
-        self.lock.release()
+        self.update(location=value)
+
+    def set_reader_location(self, reader_id, value):
+        log.info(f"Set location, {value}, reader {reader_id}")
+        with self.lock: # the locations of the other readers are kept
+            self.update(locations={**self.settings.locations, reader_id: value})
 
     @property
     def url(self):
@@ -286,10 +858,8 @@ class BadgeServer():
 
     @url.setter
     def url(self, value):
-        self.lock.acquire()
-        self.__url = value
+        self.update(url=value)
         log.info(f"Set url, {value}")
-        self.lock.release()
 
     @property
     def api_key(self):
@@ -297,10 +867,8 @@ class BadgeServer():
 
     @api_key.setter
     def api_key(self, value):
-        self.lock.acquire()
-        self.__api_key = value
+        self.update(api_key=value)
         log.info(f"Set api_key")
-        self.lock.release()
 
     @property
     def active(self):
@@ -308,10 +876,8 @@ class BadgeServer():
 
     @active.setter
     def active(self, value):
-        self.lock.acquire()
-        self.__active = value
+        self.update(active=value)
         log.info(f"Set active {value}")
-        self.lock.release()
 
     @property
     def resolution(self):
@@ -319,27 +885,103 @@ class BadgeServer():
 
     @resolution.setter
     def resolution(self, value):
-        self.lock.acquire()
-        self.__resolution = value
+        self.update(resolution=value)
         log.info(f"Set resolution {value}")
-        self.lock.release()
 
+    @property
+    def batch_window(self):
+        return "NA"
 
-server = BadgeServer()
-server.init()
+    @batch_window.setter
+    def batch_window(self, value):
+        self.uplink.batch_window = value # read by the store thread, every loop
+        log.info(f"Set batch window {value}")
 
-@app.get("/serial_port")
+
+server = BadgeServer()
+update_index = UpdateIndex("update")
+registry.gauge("rfid_readers", "Attached readers", lambda: len(server.readers))
+registry.gauge("rfid_uplink_pending", "Registrations waiting for an uplink worker", lambda: server.uplink.queue.qsize() + server.uplink.send_queue.qsize())
+registry.gauge("rfid_outbox_depth", "Registrations in the outbox", lambda: server.uplink.outbox.stats()["depth"])
+registry.gauge("rfid_badge_cache_size", "Known badges", lambda: len(badge_cache.badges))
+registry.gauge("rfid_badge_cache_hits_total", "Scanned badges that are known", lambda: badge_cache.hit_ctr, type="counter")
+registry.gauge("rfid_badge_cache_misses_total", "Scanned badges that are not known", lambda: badge_cache.miss_ctr, type="counter")
+registry.gauge("rfid_badge_cache_mismatches_total", "Feedback from the cache that is corrected by the server", lambda: badge_cache.mismatch_ctr, type="counter")
+
+
+def start_feedback():
+    feedback.start()
+    log.info(f"Audio feedback: {feedback.backend} {feedback.error or ''}")
+
+
+# the journal and the audio are opened in parallel, then the readers are discovered and started
+async def start_readers():
+    loop = asyncio.get_running_loop()
+    await asyncio.gather(loop.run_in_executor(None, open_journal), loop.run_in_executor(None, start_feedback))
+    startup.mark("journal")
+    await server.run()
+
+
+# execute at startup and shutdown.  The api is served as soon as the settings and the uplink are ready, the rest starts
+# in the background.  The readers and the hotplug detection run on the event loop of uvicorn.
+@asynccontextmanager
+async def lifespan(app: FastAPI):
+    global log_handler
+    loop = asyncio.get_running_loop()
+    if log_handler is None: # the handlers are added to log
+        log_handler = setup_logging(top_log_handle, LOG_FILENAME, LOG_LEVEL, LOG_FORMAT, LOG_QUEUE_LEN)[1]
+    log.info("start")
+    await loop.run_in_executor(None, server.init)
+    startup.mark("api")
+    log.info(f"Startup, {startup.stats()}")
+    readers_task = asyncio.create_task(start_readers())
+    try:
+        yield
+    finally:
+        readers_task.cancel()
+        await asyncio.gather(readers_task, *[r.task for r in server.readers.values()], return_exceptions=True)
+        await loop.run_in_executor(None, server.stop)
+        log.info("stop")
+
+
+# One app per process: the app uses the module level server, readers and uplink.
+def create_app():
+    app = FastAPI(lifespan=lifespan)
+    origins = ["*",]
+    app.add_middleware(
+        CORSMiddleware,
+        allow_origins=origins,
+        allow_credentials=True,
+        allow_methods=["*"],
+        allow_headers=["*"],
+        expose_headers=["*"])
+    app.include_router(router)
+    return app
+
+
+@router.get("/serial_port")
 async def get_serial_port():
     return {"port": server.port}
 
 
-@app.post("/location/{location}")
+@router.post("/location/{location}")
 def set_location(location):
     server.location = location
     return "ok"
 
 
-@app.post("/url/{url}")
+@router.post("/reader/{reader}/location/{location}")
+def set_reader_location(reader, location):
+    server.set_reader_location(reader, location)
+    return "ok"
+
+
+@router.get("/readers")
+def get_readers():
+    return server.readers_info
+
+
+@router.post("/url/{url}")
 def set_location(url):
     url = urllib.parse.unquote(url)
     url = urllib.parse.unquote(url)
@@ -347,54 +989,128 @@ def set_location(url):
     return "ok"
 
 
-@app.post("/api_key/{key}")
+@router.post("/api_key/{key}")
 def set_api_key(key):
     server.api_key = key
     return "ok"
 
 
-@app.post("/active/{setting}")
+@router.post("/active/{setting}")
 def set_active(setting):
     server.active = setting == "1"
     return "ok"
 
 
-@app.post("/resolution/{resolution}")
+@router.post("/resolution/{resolution}")
 def set_resolution(resolution):
     server.resolution = resolution
     return "ok"
 
 
-@app.get("/version")
+# window in milliseconds, 0 is no batches
+@router.post("/batch_window/{window}")
+def set_batch_window(window: int):
+    server.batch_window = window
+    return "ok"
+
+
+@router.get("/uplink")
+def get_uplink():
+    return server.uplink.stats()
+
+
+@router.get("/outbox")
+def get_outbox():
+    return server.uplink.outbox.stats()
+
+
+@router.get("/journal")
+def get_journal():
+    return scan_journal.stats() if scan_journal else {}
+
+
+# scans from the journal, e.g. /journal/scans?start=2026-01-12T08:00&end=2026-01-12T08:15&location=X or ?badge=04a1b2c3
+# start, end: local time (iso format).  The result is streamed.
+@router.get("/journal/scans")
+def get_journal_scans(start: str = None, end: str = None, location: str = None, badge: str = None, limit: int = 1000):
+    if not scan_journal:
+        return {"status": False, "data": "Journal is disabled"}
+    try:
+        start = datetime.datetime.fromisoformat(start).timestamp() if start else None
+        end = datetime.datetime.fromisoformat(end).timestamp() if end else None
+        if badge:
+            bytes.fromhex(badge)
+    except ValueError as e:
+        return {"status": False, "data": f"Wrong start, end or badge, error {e}"}
+
+    def chunks(): # a few hundred records per chunk
+        yield b'{"status":true,"data":['
+        records = []
+        first = True
+        for record in scan_journal.query(start, end, location, badge, limit):
+            record["timestamp"] = datetime.datetime.fromtimestamp(record.pop("time")).isoformat()[:23]
+            records.append(json.dumps(record))
+            if len(records) >= 256:
+                yield ("" if first else ",").encode() + ",".join(records).encode()
+                records, first = [], False
+        if records:
+            yield ("" if first else ",").encode() + ",".join(records).encode()
+        yield b"]}"
+    return StreamingResponse(chunks(), media_type="application/json")
+
+
+@router.get("/badge_cache")
+def get_badge_cache():
+    return badge_cache.stats()
+
+
+@router.get("/feedback")
+def get_feedback():
+    return feedback.stats()
+
+
+@router.get("/metrics")
+def get_metrics():
+    return Response(registry.expose(), media_type=metrics.CONTENT_TYPE)
+
+
+@router.get("/startup")
+def get_startup():
+    return startup.stats()
+
+
+# the slowest of the recent scans, per stage in ms
+@router.get("/traces")
+def get_traces(n: int = 10):
+    return {**traces.stats(), "clock": clock.stats(), "slowest": traces.slowest(n)}
+
+
+@router.get("/version")
 def get_version():
     return {"version": version}
 
 
-@app.get("/update/{versions}")
-def get_update(versions):
+# The update files are indexed once (see updates.py).  Supports If-None-Match (304 when nothing changed) and gzip.
+@router.get("/update/{versions}")
+def get_update(versions, request: Request):
     try:
         versions = versions.split("-")
         first_version = float(versions[0])
         last_version = float(versions[1])
         log.info(f"Get version from {first_version} till {last_version}")
-        files = os.listdir("update")
-        all_prefixes = [float(s.split("-")[0]) for s in files if "-" in s]
-        versions = [p for p in all_prefixes if p >= first_version and p <= last_version]
-        update_files = []
-        for version in versions:
-            if f"{version}-update.sql" in files:
-                content = open(f"update/{version}-update.sql", "r").read()
-                update_files.append(("sql", content))
-            elif f"{version}-config.py" in files:
-                content = open(f"update/{version}-config.py", "r").read()
-                update_files.append(("config", content))
-            elif f"{version}-bash.sh" in files:
-                content = open(f"update/{version}-bash.sh", "r").read()
-                update_files.append(("shell", content))
-        if "bash.sh" in files:
-            content = open(f"update/bash.sh", "r").read()
-            update_files.append(("shell", content))
-        return {"status": True, "data": update_files}
+        gzipped = "gzip" in request.headers.get("accept-encoding", "")
+        etag, body = update_index.get(first_version, last_version, gzipped)
     except Exception as e:
         return {"status": False, "data": f"Wrong versions string (x.y-w.z), erorr {e}"}
-
+    headers = {"ETag": etag, "Vary": "Accept-Encoding"}
+    if etag_matches(request.headers.get("if-none-match"), etag):
+        return Response(status_code=304, headers=headers)
+    if gzipped:
+        headers["Content-Encoding"] = "gzip"
+    if isinstance(body, bytes):
+        return Response(body, media_type="application/json", headers=headers)
+    return StreamingResponse(body, media_type="application/json", headers=headers)
+
+
+app = create_app()
+startup.mark("imported")
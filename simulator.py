@@ -0,0 +1,150 @@
+# Software emulation of a 7941W RFID reader, on a pseudo terminal (linux).  The servers open the pty like a real serial
+# port.  Badges can be presented one by one (tap) or from a script, at a configurable rate, with response jitter and
+# faults: garbage bytes, partial frames, a reader that stops answering (stall) and detaching the reader.
+#
+# In the same process, the simulated readers are found via hotplug.SIMULATED_READERS.  Standalone:
+# python simulator.py --readers 2 --rate 1
+# and start the server with the printed RFID_SIMULATED_READERS environment variable.
+
+import argparse, os, pty, random, select, threading, time, tty
+import hotplug, protocol
+
+
+def uid_response(uid):
+    body = bytes([0, protocol.Driver7941W.STATUS_UID, len(uid)]) + uid
+    return protocol.RESPONSE_HEADER + body + bytes([protocol.checksum(body)])
+
+
+NO_BADGE = bytes.fromhex("cddc00800080")
+
+
+class SimulatedReader():
+    def __init__(self, reader_id, jitter=0, garbage_rate=0, partial_rate=0, seed=None):
+        self.reader_id = reader_id
+        self.jitter = jitter # seconds, maximum random delay before a response
+        self.garbage_rate = garbage_rate # probability that random bytes are sent before a response
+        self.partial_rate = partial_rate # probability that only a part of a response is sent
+        self.random = random.Random(seed)
+        self.lock = threading.Lock()
+        self.badges = [] # [[code, present until (monotonic)]]
+        self.taps = {} # code: time.perf_counter() of the first response with this code
+        self.polls = 0
+        self.master = self.slave = None
+        self.port_name = None
+        self.generation = 0 # a serve thread of an earlier attach stops
+        self.stalled_until = 0 # monotonic, the reader does not answer, but the device node is still present
+        self.attach()
+
+    def attach(self):
+        self.master, self.slave = pty.openpty()
+        tty.setraw(self.master)
+        tty.setraw(self.slave)
+        self.port_name = os.ttyname(self.slave)
+        self.generation += 1
+        threading.Thread(target=self.serve, args=(self.master, self.generation), daemon=True, name=f"sim-{self.reader_id}").start()
+        hotplug.SIMULATED_READERS[self.reader_id] = self.port_name
+
+    # the device node disappears, as if the USB cable is pulled
+    def detach(self):
+        hotplug.SIMULATED_READERS.pop(self.reader_id, None)
+        self.generation += 1
+        for fd in (self.master, self.slave):
+            try:
+                os.close(fd)
+            except OSError:
+                pass
+        self.master = self.slave = None
+
+    # present a badge for duration seconds (code is a hex string, 8, 14 or 20 characters).  A badge that is still
+    # presented is taken away.
+    def tap(self, code, duration=0.1):
+        with self.lock:
+            self.badges = [[code, time.monotonic() + duration]]
+
+    # the reader does not answer for duration seconds, as an adapter in a bad state
+    def stall(self, duration):
+        self.stalled_until = time.monotonic() + duration
+
+    # script: [(delay in seconds, code), ...]
+    def play(self, script, duration=0.1):
+        for delay, code in script:
+            time.sleep(delay)
+            self.tap(code, duration)
+
+    def response(self):
+        with self.lock:
+            now = time.monotonic()
+            while self.badges and self.badges[0][1] < now:
+                self.badges.pop(0)
+            if not self.badges:
+                return NO_BADGE
+            code = self.badges[0][0]
+            self.taps.setdefault(code, time.perf_counter())
+        return uid_response(bytes.fromhex(code))
+
+    def serve(self, master, generation):
+        pending = b""
+        while True:
+            try:
+                select.select([master], [], [])
+                if generation != self.generation:
+                    return
+                pending += os.read(master, 256)
+            except OSError: # detached
+                return
+            while protocol.Driver7941W.READ_UID in pending:
+                pending = pending[pending.index(protocol.Driver7941W.READ_UID) + len(protocol.Driver7941W.READ_UID):]
+                if time.monotonic() < self.stalled_until:
+                    continue
+                self.polls += 1
+                response = self.response()
+                if self.jitter:
+                    time.sleep(self.random.uniform(0, self.jitter))
+                if self.random.random() < self.garbage_rate:
+                    response = bytes(self.random.randrange(256) for _ in range(self.random.randint(1, 8))) + response
+                if self.random.random() < self.partial_rate:
+                    response = response[:self.random.randint(1, len(response) - 1)]
+                try:
+                    os.write(master, response)
+                except OSError:
+                    return
+
+
+def random_code(rng, uid_length=4):
+    return bytes(rng.randrange(256) for _ in range(uid_length)).hex()
+
+
+def main():
+    parser = argparse.ArgumentParser(description="7941W RFID reader simulator")
+    parser.add_argument("--readers", type=int, default=1)
+    parser.add_argument("--rate", type=float, default=1, help="badges per second, per reader")
+    parser.add_argument("--jitter", type=float, default=0)
+    parser.add_argument("--garbage", type=float, default=0, help="probability of garbage before a response")
+    parser.add_argument("--partial", type=float, default=0, help="probability of a partial response")
+    parser.add_argument("--detach", type=float, default=0, help="seconds between detach/attach of a reader, 0 is never")
+    args = parser.parse_args()
+
+    readers = [SimulatedReader(f"sim-{i + 1}", args.jitter, args.garbage, args.partial) for i in range(args.readers)]
+    print("RFID_SIMULATED_READERS=" + ",".join(f"{r.reader_id}={r.port_name}" for r in readers))
+    rng = random.Random()
+    next_detach = time.monotonic() + args.detach if args.detach else None
+    while True:
+        time.sleep(1 / args.rate)
+        for reader in readers:
+            if reader.master is not None:
+                code = random_code(rng)
+                reader.tap(code)
+                print(f"{reader.reader_id}: {code}")
+        if next_detach and time.monotonic() > next_detach:
+            reader = rng.choice(readers)
+            if reader.master is None:
+                reader.attach()
+                print(f"{reader.reader_id}: attached {reader.port_name}")
+            else:
+                reader.detach()
+                print(f"{reader.reader_id}: detached")
+            next_detach = time.monotonic() + args.detach
+
+
+if __name__ == "__main__":
+    main()
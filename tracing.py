@@ -0,0 +1,113 @@
+# Capture time and latency trace of a scan.
+#
+# The capture time is the time.perf_counter() (monotonic) at which the last byte of the response frame is received, see
+# aserial.AsyncPort.received.  It is converted to wall time with the offset between the wall clock and perf_counter,
+# which is measured again every second: the timestamp of a scan is not delayed by the handling of the scan, and a
+# change of the wall clock (ntp) is picked up.
+#
+# A trace contains the duration of every stage of a scan, in the order of the stages, e.g.
+# serial (command sent until the response is received), decode, debounce, queue, send.  The most recent traces are kept,
+# /traces returns the slowest ones.
+
+import collections, heapq, threading, time
+
+
+class Clock():
+    def __init__(self, interval=1):
+        self.interval = interval # seconds between 2 measurements of the offset
+        self.offset = 0 # wall clock - perf_counter
+        self.measured = None # perf_counter
+        self.step_ctr = 0 # number of times the offset changed more than 1ms, i.e. the wall clock is changed
+        self.last_step = 0 # seconds
+        self.measure()
+
+    def measure(self):
+        before = time.perf_counter()
+        wall = time.time()
+        after = time.perf_counter()
+        offset = wall - (before + after) / 2
+        if self.measured is not None and abs(offset - self.offset) > 0.001:
+            self.step_ctr += 1
+            self.last_step = offset - self.offset
+        self.offset, self.measured = offset, after
+
+    # perf_counter to seconds since epoch (time.time())
+    def wall(self, perf):
+        if time.perf_counter() - self.measured >= self.interval:
+            self.measure()
+        return perf + self.offset
+
+    def stats(self):
+        return {"offset": round(self.offset, 6), "steps": self.step_ctr, "last_step": round(self.last_step, 6)}
+
+
+class Trace():
+    __slots__ = ("reader", "code", "timestamp", "captured", "stages", "last", "done")
+
+    # poll_start: the command is sent, captured: the response is received, decoded: the badge code is known
+    def __init__(self, reader, code, poll_start, captured, decoded):
+        self.reader = reader
+        self.code = code
+        self.timestamp = None # of the scan, as registered or sent
+        self.captured = captured
+        self.stages = [("serial", captured - poll_start), ("decode", decoded - captured)]
+        self.last = decoded
+        self.done = False
+
+    # the stage that ends now
+    def mark(self, stage):
+        now = time.perf_counter()
+        self.stages.append((stage, now - self.last))
+        self.last = now
+
+    def finish(self, stage):
+        self.mark(stage)
+        self.done = True
+
+    # from the capture until the last stage, the serial stage is before the capture
+    @property
+    def total(self):
+        return self.last - self.captured
+
+    # a stage that occurs more than once (e.g. a retry) is added up
+    def stats(self):
+        stages = {}
+        for stage, duration in self.stages:
+            stages[stage] = stages.get(stage, 0) + duration
+        return {"reader": self.reader, "badge_code": self.code, "timestamp": self.timestamp, "done": self.done,
+                "total_ms": round(self.total * 1000, 3), "stages_ms": {stage: round(d * 1000, 3) for stage, d in stages.items()}}
+
+
+# The most recent traces.  A trace with a key gets its next stages from other threads, see mark()
+class TraceLog():
+    def __init__(self, maxlen=1000, pending_max=10000):
+        self.recent = collections.deque(maxlen=maxlen)
+        self.pending = collections.OrderedDict() # key: Trace
+        self.pending_max = pending_max
+        self.lock = threading.Lock()
+
+    def add(self, trace, key=None):
+        with self.lock:
+            self.recent.append(trace)
+            if key is not None:
+                self.pending[key] = trace
+                while len(self.pending) > self.pending_max:
+                    self.pending.popitem(last=False)
+
+    # the stage that ends now, of the trace with this key.  last: the trace is finished
+    def mark(self, key, stage, last=False):
+        with self.lock:
+            trace = self.pending.pop(key, None) if last else self.pending.get(key)
+        if trace:
+            if last:
+                trace.finish(stage)
+            else:
+                trace.mark(stage)
+
+    def slowest(self, n=10):
+        with self.lock:
+            traces = list(self.recent)
+        return [t.stats() for t in heapq.nlargest(n, traces, key=lambda t: t.total)]
+
+    def stats(self):
+        return {"recent": len(self.recent), "pending": len(self.pending)}
@@ -0,0 +1,122 @@
+# Index of the update files in the directory update, see /update/{versions} in rfidusb.py.
+# update files: <version>-update.sql, <version>-config.py or <version>-bash.sh, and bash.sh (always sent).
+#
+# The directory is listed once and again when its modification time changes (a file is added, removed or renamed).  A
+# file that is overwritten in place does not change the directory, therefore the index is rebuilt after max_age seconds
+# as well.  Small responses are cached (plain and gzipped) until the index changes, large responses are streamed file by
+# file.  Every response has an ETag, derived from the names, sizes and modification times of the files.
+
+import collections, gzip, hashlib, json, os, threading, time, zlib
+
+
+# same format as the json responses of fastapi
+def to_json(data):
+    return json.dumps(data, ensure_ascii=False, separators=(",", ":")).encode("utf-8")
+
+
+class UpdateIndex():
+    TYPES = (("update.sql", "sql"), ("config.py", "config"), ("bash.sh", "shell")) # by priority
+
+    def __init__(self, path="update", max_age=60, cache_max=64, stream_min=64 * 1024):
+        self.path = path
+        self.max_age = max_age # seconds
+        self.cache_max = cache_max # number of cached responses
+        self.stream_min = stream_min # bytes, larger responses are streamed instead of cached
+        self.lock = threading.Lock()
+        self.mtime = None # of the directory
+        self.built = 0
+        self.files = {} # name: (size, mtime_ns)
+        self.cache = collections.OrderedDict() # (first, last, gzip): (etag, body)
+        self.build_ctr = 0
+
+    def refresh(self):
+        mtime = os.stat(self.path).st_mtime_ns
+        now = time.monotonic()
+        with self.lock:
+            if mtime == self.mtime and now - self.built < self.max_age:
+                return
+            files = {}
+            with os.scandir(self.path) as entries:
+                for entry in entries:
+                    if entry.is_file():
+                        stat = entry.stat()
+                        files[entry.name] = (stat.st_size, stat.st_mtime_ns)
+            if files != self.files:
+                self.cache.clear()
+                self.files = files
+                self.build_ctr += 1
+            self.mtime, self.built = mtime, now
+
+    # the update files for the versions from first till last (inclusive), oldest first: [(type, name), ...]
+    def select(self, first, last):
+        files = self.files
+        versions = set()
+        for name in files:
+            if "-" in name:
+                try:
+                    versions.add(float(name.split("-")[0]))
+                except ValueError: # not an update file
+                    pass
+        selected = []
+        for version in sorted(v for v in versions if first <= v <= last):
+            for suffix, type in self.TYPES:
+                if f"{version}-{suffix}" in files:
+                    selected.append((type, f"{version}-{suffix}"))
+                    break
+        if "bash.sh" in files:
+            selected.append(("shell", "bash.sh"))
+        return selected
+
+    def etag(self, selected, gzipped):
+        digest = hashlib.sha1(repr([(name, self.files.get(name)) for _, name in selected]).encode()).hexdigest()[:20]
+        return f'"{digest}{"-gzip" if gzipped else ""}"'
+
+    # the response body, one file in memory at a time
+    def chunks(self, selected):
+        yield b'{"status":true,"data":['
+        for i, (type, name) in enumerate(selected):
+            with open(os.path.join(self.path, name), "r") as f:
+                content = f.read()
+            yield (b"," if i else b"") + to_json([type, content])
+        yield b"]}"
+
+    # returns (etag, body), body is bytes (from the cache) or an iterator of bytes (large responses)
+    def get(self, first, last, gzipped=False):
+        self.refresh()
+        key = (first, last, gzipped)
+        with self.lock:
+            if key in self.cache:
+                self.cache.move_to_end(key)
+                return self.cache[key]
+            selected = self.select(first, last)
+            etag = self.etag(selected, gzipped)
+            size = sum(self.files[name][0] for _, name in selected)
+            build = self.build_ctr
+        if size >= self.stream_min:
+            return etag, gzip_stream(self.chunks(selected)) if gzipped else self.chunks(selected)
+        body = b"".join(self.chunks(selected))
+        if gzipped:
+            body = gzip.compress(body)
+        with self.lock:
+            if build == self.build_ctr: # the index did not change meanwhile
+                self.cache[key] = (etag, body)
+            while len(self.cache) > self.cache_max:
+                self.cache.popitem(last=False)
+        return etag, body
+
+
+def gzip_stream(chunks):
+    compressor = zlib.compressobj(wbits=31) # 31: gzip header
+    for chunk in chunks:
+        data = compressor.compress(chunk)
+        if data:
+            yield data
+    yield compressor.flush()
+
+
+# True if the If-None-Match header contains the etag
+def etag_matches(if_none_match, etag):
+    if not if_none_match:
+        return False
+    tags = [t.strip().removeprefix("W/") for t in if_none_match.split(",")]
+    return "*" in tags or etag in tags
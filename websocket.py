@@ -1,33 +1,48 @@
-from fastapi import FastAPI, WebSocket, WebSocketDisconnect
+from fastapi import FastAPI, WebSocket, WebSocketDisconnect, Response
 from contextlib import asynccontextmanager
-import asyncio, sys, binascii, logging, os, uvicorn
-from logging.handlers import RotatingFileHandler
-import threading, re
+import asyncio, sys, logging, os, uvicorn, collections, itertools
+import threading
 import time
 from datetime import datetime
-import serial, socket
-import serial.tools.list_ports as port_list
-
-if not "linux" in sys.platform:
-    import winsound
+import socket
+from hotplug import find_readers, HotplugWatcher
+from aserial import open_port
+from protocol import create_driver
+from health import ReaderHealth
+from tracing import Clock, Trace, TraceLog
+from debounce import DebounceCache
+from feedback import Feedback
+from logqueue import setup_logging, Sampler
+from aggregate import EdgeUplink, EdgeHub
+import wire
+import metrics
 
 LOG_HANDLE = 'FRFID'
 LOG_FILE = 'frid-log'
 LOG_LEVEL = "INFO"
+LOG_FORMAT = "text" # text or json (one json object per line)
+LOG_QUEUE_LEN = 10000 # log records waiting to be written, dropped when full
+WS_CLIENT_QUEUE_LEN = 1024 # number of events buffered per websocket client
+WS_SLOW_CLIENT_POLICY = "drop_oldest" # drop_oldest, coalesce or disconnect, when the queue of a websocket client is full
+WS_REPLAY_LEN = 1024 # number of recent events kept, for websocket clients that reconnect with last_seq
+WS_FLUSH_WINDOW = 0.02 # seconds, a batched wire format (wire.py) sends the events that arrive within this window together
+WS_BATCH_MAX = 500 # events per message, batched wire format
+HUB_MODE = False # hub: accept the events of the edges on /edge.  The edges are not authenticated, only on a trusted network
+HUB_URL = None # edge: forward the events to the hub, e.g. "ws://hub:8765/edge".  None: no hub, see aggregate.py
+NODE_NAME = socket.gethostname() # the events of this edge are tagged with the node name on the hub
+POLL_INTERVAL = 0.02 # seconds, time between 2 polls of a reader
+DEBOUNCE_WINDOW = 2 # seconds, same badge is not sent again within this window, on any reader
+DEBOUNCE_MAX = 10000 # maximum number of badges that are remembered
+READER_MODEL = "7941W" # see protocol.DRIVERS
+HEALTH_STALL_TIMEOUT = 3 # seconds without an answer of a reader, then its port is closed and opened again
+HEALTH_PROBE_INTERVAL = 5 # seconds, a reader that is not polled (not active) is probed
+HEALTH_BACKOFF_MAX = 30 # seconds, maximum wait before a reader that keeps stalling is opened again
+TRACE_LEN = 1000 # number of recent scans with a latency trace, see /traces
 
-#  enable logging
+#  enable logging, via a queue: the serial workers and the event loop do not wait for the disk
 top_log_handle = LOG_HANDLE
-log = logging.getLogger(top_log_handle)
 LOG_FILENAME = os.path.join(sys.path[0], f'log/{LOG_FILE}.txt')
-try:
-    log_level = getattr(logging, LOG_LEVEL)
-except:
-    log_level = getattr(logging, 'INFO')
-log.setLevel(log_level)
-log_handler = RotatingFileHandler(LOG_FILENAME, maxBytes=1024 * 1024, backupCount=20)
-log_formatter = logging.Formatter('%(asctime)s - %(levelname)s - %(name)s - %(message)s')
-log_handler.setFormatter(log_formatter)
-log.addHandler(log_handler)
+log, log_handler = setup_logging(top_log_handle, LOG_FILENAME, LOG_LEVEL, LOG_FORMAT, LOG_QUEUE_LEN)
 
 # 0.15 initial version of websockets
 # 0.16: when changing the administered state, return (ws event) the adminstered state anded with the operational state
@@ -36,201 +51,561 @@ log.addHandler(log_handler)
 # when required.
 # 0.18: added hostname for logging
 # 0.19: added logging.  Bugfixed issue with same_code_ctr
+# 0.20: replaced global_send_data by a bounded event queue.  serial_worker wakes up ws_sender immediately, no events are lost.
+# 0.21: broadcast hub, every event is sent to every websocket client.  Every client has its own queue and slow-client policy.
+# 0.25: multiple RFID readers.  Every reader has its own thread, events are tagged with the reader id.
+# 0.26: attached/detached readers are detected with inotify (linux).  A new port is opened with increasing delays.
+# 0.27: read exactly one response frame instead of waiting for the serial timeout.  Poll every 20ms instead of 200ms.
+# 0.28: the reader protocol is moved to protocol.py, with a driver per reader model.  Support for 7 and 10 byte uids.
+# 0.29: added /metrics (prometheus)
+# 0.30: repeated scans are suppressed per badge during a time window (DEBOUNCE_WINDOW), shared by the readers.
+# 0.31: beeps are played by a feedback worker (feedback.py), the /tmp/beep-request file and the external script are not used anymore.
+# 0.32: log records are written to the file by a separate thread (logqueue.py).  Optional json format.  Received frames are
+# logged at debug level, at most once per second.
+# 0.35: the readers and the hotplug detection run on the event loop (aserial.py), no serial threads anymore.
+# 0.38: every event has a sequence number (seq).  A client that reconnects with /ws?last_seq=<seq> first receives the
+# events it missed, in one message.
+# 0.39: edge-to-hub aggregation (aggregate.py).  An edge forwards its events to the hub (HUB_URL) over one websocket, the
+# hub (HUB_MODE) merges the events of all edges into one stream, tagged with the node.
+# 0.40: opt-in batched wire formats (wire.py), negotiated with the websocket subprotocol: rfid.json-batch and rfid.msgpack.
+# 0.42: reader watchdog (health.py), a reader that does not answer anymore is closed and opened again.  scanner_state
+# contains the health of the reader.
+# 0.44: the timestamp of a scan is the time the response of the reader is received (tracing.py).  Every scan has a trace of
+# the duration of its stages, the slowest recent scans are available at /traces.
+
+version = "0.44"
+
+registry = metrics.Registry()
+serial_rtt = registry.histogram("rfid_serial_rtt_seconds", "Time to send a command to the reader and receive the response")
+poll_cycle = registry.histogram("rfid_poll_cycle_seconds", "Time to handle one poll of a reader")
+scan_to_websocket = registry.histogram("rfid_scan_to_websocket_seconds", "Time between a scan and the event sent to a websocket client")
+scans = registry.counter("rfid_scans_total", "Scans sent to the websocket clients")
+duplicates = registry.counter("rfid_duplicates_total", "Scans that are suppressed because the same badge was scanned just before")
+reconnects = registry.counter("rfid_port_reconnects_total", "Number of times a reader port is opened")
+recoveries = registry.counter("rfid_reader_recoveries_total", "Number of times a stalled reader is closed and opened again")
 
-version = "0.19"
+# recently scanned badges, shared by the readers
+debounce = DebounceCache(DEBOUNCE_WINDOW, DEBOUNCE_MAX)
+registry.gauge("rfid_debounce_badges", "Number of recently scanned badges that are remembered", lambda: len(debounce))
+
+feedback = Feedback()
+frame_sampler = Sampler(1) # log at most one received frame per second
+clock = Clock()
+traces = TraceLog(TRACE_LEN)
+registry.gauge("rfid_log_dropped_total", "Log records dropped because the log queue is full", lambda: log_handler.dropped_ctr, type="counter")
 
 class RfidScanner():
-    def __init__(self):
-        self.port_name = "" # e.g. /dev/ttyUSB0.  Normally, the correct port is returned (with the RFID reader attached)
-        self.system_port = None # pointer to the serial port
+    def __init__(self, reader_id, port_name):
+        self.reader_id = reader_id
+        self.port_name = port_name # e.g. /dev/ttyUSB0
+        self.system_port = None # aserial.AsyncPort
         self.active = True
-        self.os_is_linux = "linux" in sys.platform
-        self.read_uid = bytearray(b'\xab\xba\x00\x10\x00\x10')
-        self.resp_len = 2405
-        self.prev_code = ""
-        self.same_code_ctr = 0
-        self.current_port_name = None
-        self.log_port_disabled = True
+        self.driver = create_driver(READER_MODEL)
         self.hostname = socket.gethostname()
+        self.task = None
+        self.trace = None # tracing.Trace of the last scan
+        self.health = ReaderHealth(HEALTH_STALL_TIMEOUT, HEALTH_PROBE_INTERVAL, HEALTH_BACKOFF_MAX)
 
-    def beep(self):
-        if self.os_is_linux:
-            with open('/tmp/beep-request', 'w') as f:
-                f.write('beep\n')
-        else:
-            winsound.Beep(1500, 200)
-
-    def read(self): # about every 200ms
+    async def read(self): # about every 20ms
+        if self.system_port and not self.active and self.health.probe_due():
+            await self.probe()
         if self.system_port and self.active:
             try:
-                self.system_port.write(self.read_uid) # command to get the serial number
-                rcv_raw = self.system_port.read(self.resp_len)
-                if rcv_raw:
-                    rcv = binascii.hexlify(rcv_raw).decode("UTF-8")
-                    log.debug(f"system-port read {rcv}, prev_code {self.prev_code}, same_code_ct {self.same_code_ctr}")
-                    if rcv[6:8] == "81":  # valid uid received
-                        code = rcv[10:18]
-                        if code != self.prev_code or self.same_code_ctr <= 0: # wait at least 2 seconds before the same badge can be scanned or continue directly when a different badge is scanned.
-                            timestamp = datetime.now().isoformat()[:23]
-                            self.same_code_ctr = 10 # 10 x 200ms = 2 secs
-                            self.prev_code = code
-                            self.beep()
-                            return {"timestamp": timestamp, "code": code, "hostname": self.hostname}
-                self.same_code_ctr -= 1 if self.same_code_ctr > 0 else 0
+                poll_start = time.perf_counter()
+                code = await self.system_port.poll(self.driver) # get the serial number of the badge, if present
+                decoded = time.perf_counter()
+                serial_rtt.observe(decoded - poll_start)
+                self.record(self.driver.last_frame is not None)
+                if log.isEnabledFor(logging.DEBUG) and frame_sampler.allow():
+                    log.debug("system-port read %s, reader %s", self.driver.last_frame, self.reader_id)
+                if code:
+                    captured = self.system_port.received # the response is received
+                    if debounce.accept(code): # the same badge is not sent again within DEBOUNCE_WINDOW seconds
+                        trace = Trace(self.reader_id, code, poll_start, captured, decoded)
+                        trace.timestamp = timestamp = datetime.fromtimestamp(clock.wall(captured)).isoformat()[:23]
+                        feedback.play("ok", captured) # does not wait, the beep is played by the feedback worker
+                        scans.inc()
+                        trace.mark("debounce")
+                        traces.add(trace)
+                        self.trace = trace
+                        return {"timestamp": timestamp, "code": code, "hostname": self.hostname, "reader": self.reader_id}
+                    duplicates.inc()
                 return None
             except Exception as e:
-                log.info(f"Port detattached, {e}")
+                if not self.health.streak: # once, not at every poll
+                    log.info(f"Port detattached, {e}")
+                self.record(False, e)
             return None
 
-    def check_usb_port(self):
-        if self.os_is_linux:
-            port_names = [p.name for p in port_list.comports() if "usb" in p.name.lower()]
-            port_name = port_names[0] if len(port_names) > 0 else None
-            self.port_name = "/dev/" + port_name if port_name else ""
-        else:
-            port_names = [p.description for p in list(port_list.comports()) if "ch340" in p.description.lower()]
-            port_name = port_names[0] if len(port_names) > 0 else None
-            if port_name:
-                port_match = re.search(r"\((.*)\)", port_name)
-                if port_match:
-                    if not self.port_name:
-                        time.sleep(1)
-                    self.port_name = port_match[1]
+    # the reader is not polled, check that it still answers
+    async def probe(self):
+        try:
+            await self.system_port.poll(self.driver)
+            self.record(self.driver.last_frame is not None)
+        except Exception as e:
+            self.record(False, e)
+
+    def record(self, answered, error=None):
+        if self.health.record(answered, error):
+            log.info(f"Reader {self.reader_id} is {self.health.state}")
+            event_queue.put({"scanner_state": self.state})
+
+    # close the port and open it again, with a new driver.  Returns False when the port could not be opened
+    async def recover(self):
+        log.error(f"Reader {self.reader_id} does not answer for {HEALTH_STALL_TIMEOUT} seconds, reopen the port")
+        self.health.recovering()
+        recoveries.inc()
+        self.close_port()
+        event_queue.put({"scanner_state": self.state})
+        await asyncio.sleep(self.health.backoff())
+        self.driver = create_driver(READER_MODEL)
+        if not await self.open_port():
+            return False
+        self.health.reopened()
+        event_queue.put({"scanner_state": self.state})
+        return True
+
+    async def open_port(self):
+        self.system_port = await open_port(self.port_name)
+        if self.system_port:
+            log.info(f"Set Serial port, id {self.port_name}, reader {self.reader_id}")
+            reconnects.inc()
+            return True
+        log.error(f"Tried to open port {self.port_name} for 10 seconds, did not work")
+        return False
+
+    def close_port(self):
+        if self.system_port:
+            self.system_port.close()
+        self.system_port = None
+        log.info(f"Disable Serial port, id {self.port_name}, reader {self.reader_id}")
+
+    @property
+    def state(self):
+        return {"state": self.system_port is not None and self.active, "reader": self.reader_id, "health": self.health.state}
+
+    # on the event loop
+    def start(self):
+        self.task = asyncio.create_task(serial_worker(self), name=f"reader-{self.reader_id}")
+
+    def stop(self):
+        self.task.cancel()
+
+
+# Bounded queue to pass events from serial_worker to the hub and ws_sender.
+# put() is called on the event loop, or from another thread: then the event is handed over to the event loop with
+# call_soon_threadsafe.  When the queue is full, the oldest event is dropped and counted as overflow.
+# The queue contains (event, trace), trace is the tracing.Trace of a scan (or None), to measure the latency.
+class EventQueue():
+    def __init__(self, maxlen=256):
+        self.maxlen = maxlen
+        self.events = collections.deque()
+        self.wakeup = None
+        self.loop = None
+        self.loop_thread = None
+        self.overflow_ctr = 0
+        self.max_depth = 0
+
+    # to be called from the event loop, before the readers are started
+    def attach(self, loop):
+        self.loop = loop
+        self.loop_thread = threading.get_ident()
+        self.wakeup = asyncio.Event()
+
+    # thread safe
+    def put(self, event, trace=None):
+        if self.loop:
+            if threading.get_ident() == self.loop_thread:
+                self.__put((event, trace))
             else:
-                self.port_name = ""
-        if self.port_name:
-            status = True
-            if self.port_name != self.current_port_name: # if the reader is switched to another port
-                # Although the port is present as /dev/ttyUSBxx, it is not accessible yet.  Try a few times with a delay in between
-                try_to_open_port = 10
-                while try_to_open_port > 0:
-                    try:
-                        self.system_port = serial.Serial(self.port_name, baudrate=115200, bytesize=serial.EIGHTBITS, parity=serial.PARITY_NONE, stopbits=serial.STOPBITS_ONE, timeout=0.1)
-                        log.info(f"Set Serial port, id {self.port_name}")
-                        try_to_open_port = 0
-                        status = True
-                    except Exception as e:
-                        time.sleep(1)
-                        try_to_open_port -= 1
-                        if try_to_open_port <= 0:
-                            log.error(f"Tried to open port {self.port_name} 10 times, did not work")
-                            status = False
-                self.current_port_name = self.port_name
-                self.log_port_disabled = True
-        else: # reader is detached
-            if self.system_port:
-                self.system_port.close()
-            self.system_port = self.current_port_name = None
-            if self.log_port_disabled:
-                log.info(f"Disable Serial port")
-                self.log_port_disabled = False
-            time.sleep(2)
-            status = False
-        return status
-
-
-global_send_data = None
-global_send_data_available = False
-global_receive_data = None
-global_receive_data_available = False
-lock = threading.Lock()
-stop_event = threading.Event()
-
-# Accesses the RFID scanner via the serial/USB interface.
-# It is a separate thread because it is not sure if the serial library is blocking or not.  If it is blocking, using async would block the whole program.
-# It cannot use websockets directly, so it uses a lock to hand over the scanned RFID to ws_sender.
-def serial_worker():
-    global global_send_data
-    global global_send_data_available
-    global global_receive_data
-    global global_receive_data_available
-    check_usb_port_ctr = 0 # every loop takes 0.2 sec.  usb-port is checked every 10 * 0.2 sec (2 sec)
-    previous_scanner_state = False
-    rfid_scanner = RfidScanner()
-
-    while not stop_event.is_set():
-        cycle_start = datetime.now()
-        if check_usb_port_ctr > 10:
-            scanner_state = rfid_scanner.check_usb_port()
-            if scanner_state != previous_scanner_state:
-                previous_scanner_state = scanner_state
-                with lock:
-                    global_send_data_available = True
-                    global_send_data = {"scanner_state": {"state": scanner_state}}
-                    log.info(f"ws send {global_send_data}")
-            check_usb_port_ctr = 0
-        read_result = rfid_scanner.read()
-        if read_result is not None:
-            with lock:
-                global_send_data_available = True
-                global_send_data = {"read": read_result}
-                log.info(f"ws send {global_send_data}")
-        check_usb_port_ctr += 1
-        with lock:
-            if global_receive_data_available:
-                global_receive_data_available = False
-                log.info(f"ws received {global_receive_data}")
-                if "status" in global_receive_data:
-                    rfid_scanner.active = global_receive_data["status"]
-                    global_send_data_available = True
-                    global_send_data = {"scanner_state": {"state": previous_scanner_state and rfid_scanner.active}}
-        cycle_delta = (datetime.now() - cycle_start).microseconds / 1000 # number of milliseconds
-        if cycle_delta < 200:
-            time.sleep((200 - cycle_delta) / 1000)
+                self.loop.call_soon_threadsafe(self.__put, (event, trace))
+
+    # executed on the event loop
+    def __put(self, item):
+        if len(self.events) >= self.maxlen:
+            self.events.popleft()
+            self.overflow_ctr += 1
+        self.events.append(item)
+        self.max_depth = max(self.max_depth, len(self.events))
+        self.wakeup.set()
+
+    async def get(self):
+        while not self.events:
+            self.wakeup.clear()
+            await self.wakeup.wait()
+        return self.events.popleft()
+
+    @property
+    def depth(self):
+        return len(self.events)
+
+    def stats(self):
+        return {"depth": self.depth, "max_depth": self.max_depth, "maxlen": self.maxlen, "overflow": self.overflow_ctr}
+
+
+# the reader of a scanner_state event, per edge on a hub (see aggregate.py)
+def scanner_key(event):
+    return event.get("node"), event["scanner_state"].get("reader")
+
+
+# A websocket client that subscribed to the hub.  Lives on the event loop, no locking required.
+# Contains (event, trace), see EventQueue
+class Subscriber():
+    def __init__(self, maxlen, policy):
+        self.maxlen = maxlen
+        self.policy = policy
+        self.events = collections.deque()
+        self.wakeup = asyncio.Event()
+        self.dropped_ctr = 0
+        self.closed = False
+        self.replay = None # message with the missed events, sent first
+        self.format = "json" # wire format, see wire.py
+
+    def push(self, item):
+        if self.policy == "coalesce" and "scanner_state" in item[0]:
+            # only the latest scanner state of a reader is relevant, remove its pending ones
+            reader = scanner_key(item[0])
+            pending = len(self.events)
+            self.events = collections.deque(i for i in self.events if "scanner_state" not in i[0] or scanner_key(i[0]) != reader)
+            self.dropped_ctr += pending - len(self.events)
+        if len(self.events) >= self.maxlen:
+            if self.policy == "disconnect":
+                self.closed = True
+                self.wakeup.set()
+                return
+            self.events.popleft()
+            self.dropped_ctr += 1
+        self.events.append(item)
+        self.wakeup.set()
+
+    # returns None when the subscriber is closed
+    async def get(self):
+        while not self.events and not self.closed:
+            self.wakeup.clear()
+            await self.wakeup.wait()
+        return None if self.closed else self.events.popleft()
+
+    # returns None when no event is available
+    def get_nowait(self):
+        return None if self.closed or not self.events else self.events.popleft()
+
+
+# Delivers every event of event_queue to every subscriber.  A slow subscriber only fills up its own queue, it never
+# delays the other subscribers.
+# Every event gets a sequence number (seq) and the most recent events are kept in a ring buffer.  A client that
+# reconnects with the last seq it received, gets the missed events in one message:
+# {"replay": [events], "complete": true/false, "seq": <latest seq>}.  complete is false when events are missing, i.e.
+# last_seq is older than the ring buffer, or it is from before a restart: then the client should do a full resync.
+# The sequence numbers start at the time of startup (in ms), i.e. they keep increasing after a restart.
+class BroadcastHub():
+    def __init__(self, maxlen=WS_CLIENT_QUEUE_LEN, policy=WS_SLOW_CLIENT_POLICY, replay_len=WS_REPLAY_LEN):
+        self.maxlen = maxlen
+        self.policy = policy
+        self.subscribers = set()
+        self.history = collections.deque(maxlen=replay_len) # (event, trace), event with seq
+        self.seq = int(time.time() * 1000) # of the last event
+        self.event_ctr = 0
+        self.dropped_ctr = 0 # dropped events of subscribers that are gone
+        self.disconnect_ctr = 0
+        self.replay_ctr = 0
+        self.incomplete_ctr = 0
+
+    # last_seq: the client reconnects, the missed events are stored in subscriber.replay
+    def subscribe(self, last_seq=None, maxlen=None, policy=None):
+        subscriber = Subscriber(maxlen or self.maxlen, policy or self.policy)
+        if last_seq is not None:
+            subscriber.replay = self.replay(last_seq)
+        self.subscribers.add(subscriber)
+        return subscriber
+
+    # the events after last_seq, in one message
+    def replay(self, last_seq):
+        oldest = self.history[0][0]["seq"] if self.history else self.seq + 1
+        complete = oldest - 1 <= last_seq <= self.seq # the sequence numbers in history are consecutive
+        start = max(0, last_seq - oldest + 1) if complete else 0
+        self.replay_ctr += 1
+        self.incomplete_ctr += not complete
+        events = [event for event, _ in itertools.islice(self.history, start, None)]
+        return {"replay": events, "complete": complete, "seq": self.seq}
+
+    def unsubscribe(self, subscriber):
+        if subscriber in self.subscribers:
+            self.subscribers.remove(subscriber)
+            self.dropped_ctr += subscriber.dropped_ctr
+            if subscriber.closed:
+                self.disconnect_ctr += 1
+
+    def publish(self, item):
+        if item[1] is not None:
+            item[1].mark("queue")
+        self.event_ctr += 1
+        self.seq += 1
+        item = ({**item[0], "seq": self.seq}, item[1])
+        self.history.append(item)
+        for subscriber in self.subscribers:
+            if not subscriber.closed:
+                subscriber.push(item)
+
+    async def run(self, queue):
+        while True:
+            self.publish(await queue.get())
+
+    def stats(self):
+        return {"clients": len(self.subscribers), "policy": self.policy, "maxlen": self.maxlen, "events": self.event_ctr,
+                "dropped": self.dropped_ctr + sum(s.dropped_ctr for s in self.subscribers), "disconnected": self.disconnect_ctr,
+                "formats": dict(collections.Counter(s.format for s in self.subscribers)),
+                "seq": self.seq, "history": len(self.history), "replays": self.replay_ctr, "incomplete_replays": self.incomplete_ctr}
+
+
+event_queue = EventQueue()
+hub = BroadcastHub()
+edges = EdgeHub(hub.publish) # the edges that forward their events to this instance
+uplink = EdgeUplink(hub, HUB_URL, NODE_NAME) if HUB_URL else None
+
+# Accesses an RFID scanner via the serial/USB interface, every scanner has its own task on the event loop (see
+# aserial.py).  The scanned RFID is handed over to the hub via event_queue.  Stopped by cancelling the task.
+async def serial_worker(rfid_scanner):
+    try:
+        if await rfid_scanner.open_port():
+            send_data = {"scanner_state": {"state": True, "reader": rfid_scanner.reader_id}}
+            event_queue.put(send_data)
+            log.info("ws send %s", send_data)
+            while True:
+                if rfid_scanner.health.stalled and not await rfid_scanner.recover():
+                    return # the reader manager starts a new serial_worker
+                cycle_start = time.monotonic()
+                read_result = await rfid_scanner.read()
+                if read_result is not None:
+                    send_data = {"read": read_result}
+                    event_queue.put(send_data, rfid_scanner.trace)
+                    log.info("ws send %s", send_data)
+                cycle_delta = time.monotonic() - cycle_start
+                poll_cycle.observe(cycle_delta)
+                await asyncio.sleep(max(0, POLL_INTERVAL - cycle_delta))
+    finally:
+        rfid_scanner.close_port()
+        send_data = {"scanner_state": {"state": False, "reader": rfid_scanner.reader_id}}
+        event_queue.put(send_data)
+        log.info("ws send %s", send_data)
+
+
+# Checks which readers are attached, when a device node appears or disappears (or every 2 seconds).  Starts a
+# serial_worker for every new reader and stops the serial_worker of a detached reader.  Runs on the event loop.
+class ReaderManager():
+    def __init__(self):
+        self.readers = {}
+        self.active = True
+
+    async def run(self):
+        loop = asyncio.get_running_loop()
+        watcher = HotplugWatcher()
+        log.info(f"Reader hotplug detection: {watcher.mode} {watcher.error or ''}")
+        try:
+            while True:
+                await self.scan(loop)
+                await watcher.wait_async(2)
+        finally:
+            for reader in self.readers.values():
+                reader.stop()
+            watcher.close()
+
+    async def scan(self, loop):
+        try:
+            ports = await loop.run_in_executor(None, find_readers) # lists /sys, blocking
+            for reader_id, port_name in ports.items():
+                reader = self.readers.get(reader_id)
+                if reader and (reader.port_name != port_name or reader.task.done()):
+                    reader.stop()
+                    reader = None
+                if not reader:
+                    reader = RfidScanner(reader_id, port_name)
+                    reader.active = self.active
+                    reader.start()
+                    self.readers[reader_id] = reader
+            for reader_id in [r for r in self.readers if r not in ports]: # reader is detached
+                self.readers.pop(reader_id).stop()
+        except Exception as e:
+            log.error(f"Reader manager, {e}")
+
+    # executed on the event loop, e.g. {"status": True}
+    def command(self, data):
+        log.info("ws received %s", data)
+        if "status" in data:
+            self.active = data["status"]
+            readers = list(self.readers.values())
+            for reader in readers:
+                reader.active = self.active
+                event_queue.put({"scanner_state": reader.state})
+            if not readers:
+                event_queue.put({"scanner_state": {"state": False}})
+
+    def stats(self):
+        return [{"reader": r.reader_id, "port": r.port_name, **r.state, **r.health.stats()} for r in list(self.readers.values())]
+
+
+reader_manager = ReaderManager()
+registry.gauge("rfid_readers", "Attached readers", lambda: len(reader_manager.readers))
+registry.gauge("rfid_websocket_clients", "Connected websocket clients", lambda: len(hub.subscribers))
+registry.gauge("rfid_event_queue_depth", "Events waiting to be sent to the websocket clients", lambda: event_queue.depth)
+registry.gauge("rfid_edges", "Connected edges (hub)", lambda: edges.stats()["connected"])
+registry.gauge("rfid_edge_events_total", "Events received from the edges (hub)", lambda: edges.event_ctr, type="counter")
+registry.gauge("rfid_dropped_events_total", "Events dropped because a queue is full", lambda: event_queue.overflow_ctr + hub.stats()["dropped"], type="counter")
 
 # execute at startup and shutdown
 @asynccontextmanager
 async def lifespan(app: FastAPI):
-    # startup, start serial thread
-    log.info("Starting serial worker thread")
-    thread = threading.Thread(target=serial_worker, daemon=True)
-    thread.start()
+    # startup, start reader manager
+    log.info("Starting reader manager")
+    event_queue.attach(asyncio.get_running_loop())
+    feedback.start()
+    log.info(f"Audio feedback: {feedback.backend} {feedback.error or ''}")
+    hub_task = asyncio.create_task(hub.run(event_queue))
+    manager_task = asyncio.create_task(reader_manager.run())
+    uplink_task = asyncio.create_task(uplink.run()) if uplink else None
+    if uplink:
+        log.info(f"Forward the events to hub {HUB_URL}, node {NODE_NAME}")
 
     try:
         yield
     finally:
         # shutdown
-        log.info("Stopping serial worker thread")
-        stop_event.set()
-        thread.join(timeout=2)
+        log.info("Stopping reader manager and serial workers")
+        manager_task.cancel()
+        await asyncio.gather(manager_task, *[r.task for r in reader_manager.readers.values()], return_exceptions=True)
+        hub_task.cancel()
+        if uplink_task:
+            uplink_task.cancel()
 
 app = FastAPI(lifespan=lifespan)
 
-# async cannot block (i.e. cannot use blocking libraries), therefore use a lock to sync data between serial_worker and this function.
-async def ws_sender(ws: WebSocket):
-    global global_send_data_available
+# The events of serial_worker are passed via event_queue and the hub.  Every websocket client has its own subscriber.
+async def ws_sender(ws: WebSocket, subscriber: Subscriber):
+    try:
+        if subscriber.replay is not None:
+            await ws.send_json(subscriber.replay)
+        while True:
+            item = await subscriber.get()
+            if item is None: # too slow, disconnect
+                log.info("ws client too slow, disconnect")
+                await ws.close(code=1013)
+                return
+            data, trace = item
+            await ws.send_json(data)
+            if trace is not None:
+                scan_to_websocket.observe(time.perf_counter() - trace.captured)
+                if not trace.done: # the first client
+                    trace.finish("send")
+    except Exception:
+        pass
+
+
+# Batched wire format: the first event of a burst is sent at once, the events that follow within WS_FLUSH_WINDOW are
+# sent together in the next message.
+async def ws_batch_sender(ws: WebSocket, subscriber: Subscriber):
+    encode = wire.FORMATS[subscriber.format]
     try:
-        data = None
+        items = [(subscriber.replay, None)] if subscriber.replay is not None else []
+        last_sent = 0
         while True:
-            await asyncio.sleep(1)
-            with lock:
-                if global_send_data_available:
-                    global_send_data_available = False
-                    data = global_send_data
-            if data is not None:
-                await ws.send_json(data)
-                data = None
+            if not items:
+                item = await subscriber.get()
+                if item is None: # too slow, disconnect
+                    log.info("ws client too slow, disconnect")
+                    await ws.close(code=1013)
+                    return
+                items.append(item)
+            wait = last_sent + WS_FLUSH_WINDOW - time.perf_counter()
+            if wait > 0:
+                await asyncio.sleep(wait)
+            while len(items) < WS_BATCH_MAX:
+                item = subscriber.get_nowait()
+                if item is None:
+                    break
+                items.append(item)
+            message = encode([data for data, _ in items])
+            if isinstance(message, str):
+                await ws.send_text(message)
+            else:
+                await ws.send_bytes(message)
+            last_sent = time.perf_counter()
+            for _, trace in items:
+                if trace is not None:
+                    scan_to_websocket.observe(last_sent - trace.captured)
+                    if not trace.done: # the first client
+                        trace.finish("send")
+            items = []
     except Exception:
         pass
 
 
+@app.get("/queue")
+def get_queue():
+    return {**event_queue.stats(), "hub": hub.stats()}
+
+
+@app.get("/readers")
+def get_readers():
+    return reader_manager.stats()
+
+
+@app.get("/feedback")
+def get_feedback():
+    return feedback.stats()
+
+
+@app.get("/edges")
+def get_edges():
+    return {**edges.stats(), "uplink": uplink.stats() if uplink else None}
+
+
+# the slowest of the recent scans, with the duration of every stage
+@app.get("/traces")
+def get_traces(n: int = 10):
+    return {**traces.stats(), "clock": clock.stats(), "slowest": traces.slowest(n)}
+
+
+@app.get("/metrics")
+def get_metrics():
+    return Response(registry.expose(), media_type=metrics.CONTENT_TYPE)
+
+
 @app.websocket("/ws")
-async def websocket_endpoint(ws: WebSocket):
-    global global_receive_data
-    global global_receive_data_available
-    await ws.accept()
-    task = asyncio.create_task(ws_sender(ws))
+async def websocket_endpoint(ws: WebSocket, last_seq: int = None):
+    subprotocol = wire.choose(ws.scope.get("subprotocols", []))
+    await ws.accept(subprotocol=subprotocol)
+    subscriber = hub.subscribe(last_seq)
+    if subprotocol:
+        subscriber.format = subprotocol
+        task = asyncio.create_task(ws_batch_sender(ws, subscriber))
+    else:
+        task = asyncio.create_task(ws_sender(ws, subscriber))
 
     try:
         while True:
             data = await ws.receive_json()
-            with lock:
-                global_receive_data_available = True
-                global_receive_data = data
+            reader_manager.command(data)
     except WebSocketDisconnect:
         pass
     finally:
         task.cancel()
+        hub.unsubscribe(subscriber)
+
+
+# an edge forwards its events, see aggregate.py.  Only mounted on a hub (HUB_MODE)
+async def edge_endpoint(ws: WebSocket, node: str):
+    await ws.accept()
+    log.info(f"edge {node} connected")
+    try:
+        await edges.serve(ws, node)
+    except WebSocketDisconnect:
+        pass
+    except Exception as e:
+        log.error(f"edge {node}, {e}")
+    log.info(f"edge {node} disconnected")
+
+
+if HUB_MODE:
+    app.add_api_websocket_route("/edge", edge_endpoint)
 
 
 if __name__ == "__main__":
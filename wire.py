@@ -0,0 +1,35 @@
+# Wire formats of the websocket events (/ws), negotiated with the websocket subprotocol (Sec-WebSocket-Protocol).  The
+# client offers one or more subprotocols, the first one that is supported is used.  Without a subprotocol, every event is
+# sent as a json text message (the default, as before).
+#
+# rfid.json-batch: a json array of events per text message
+# rfid.msgpack: a MessagePack array of events per binary message, only when msgpack is installed
+#
+# In a batched format, the events that arrive within a short flush window are sent in one message, see ws_sender in
+# websocket.py.  Compression (permessage-deflate) is negotiated by the websocket extension, uvicorn accepts it when the
+# client offers it.  It pays off with batches: a single event is too small to compress.
+
+import json
+
+try:
+    import msgpack
+except ImportError:
+    msgpack = None
+
+
+def encode_json(events):
+    return json.dumps(events, separators=(",", ":"))
+
+
+FORMATS = {"rfid.json-batch": encode_json} # subprotocol: encoder, returns str (text message) or bytes (binary message)
+if msgpack:
+    FORMATS["rfid.msgpack"] = msgpack.Packer().pack
+
+
+# offered: the subprotocols of the client, in order of preference.  Returns the subprotocol or None (one json message
+# per event)
+def choose(offered):
+    for subprotocol in offered:
+        if subprotocol in FORMATS:
+            return subprotocol
+    return None